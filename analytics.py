@@ -2,14 +2,37 @@ import utils
 import random
 from datetime import datetime
 
+from track_aggregation import is_track_record
+from zones import CameraZones, load_zones
+
 OBJECT_TYPES = ["cat", "raccoon", "possum"]
 
+def to_datetime(timestamp):
+    """ Log timestamps are epoch seconds, or readable strings in the legacy .json logs. """
+    if isinstance(timestamp, str):
+        return datetime.strptime(timestamp, utils.DATETIME_FORMAT_READABLE_SECOND)
+    return datetime.fromtimestamp(timestamp)
+
+def iter_detections(video_log):
+    """ Yields (timestamp, detections) from per-frame detection lists and from track records.
+
+    A track record yields each trajectory point as a detection carrying the track's name and mean
+    confidence, weighted so a track counts as many detections as the frames it was seen in.
+    """
+    for timestamp, data in video_log:
+        if isinstance(data, list):
+            yield timestamp, data
+        elif is_track_record(data):
+            for point_ts, box in data['trajectory']:
+                yield point_ts, [{'name': data['name'], 'box': box, 'confidence': data['confidence']['mean'],
+                                  'weight': data['detections'] / len(data['trajectory'])}]
+
 def generate_location_analytics(logs):
     locations = {o: [] for o in OBJECT_TYPES}
     for k, video_log in logs.items():
         if video_log is None:
             print(k)
-        for _, detection in video_log:
+        for _, detection in iter_detections(video_log):
             for d in detection:
                 if d['name'] not in locations:
                     continue
@@ -27,13 +50,31 @@ def generate_location_analytics(logs):
 def generate_active_hour_analytics(logs):
     active_hours_data = {o: [0]*24 for o in OBJECT_TYPES}
     for video_log in logs.values():
-        for timestamp, detection in video_log:
-            hour = datetime.strptime(timestamp, utils.DATETIME_FORMAT_READABLE_SECOND).hour
-            objects = set([d['name'] for d in detection])
-            for o in objects:
+        for timestamp, detection in iter_detections(video_log):
+            hour = to_datetime(timestamp).hour
+            objects = {d['name']: d.get('weight', 1) for d in detection}
+            for o, weight in objects.items():
                 if o in OBJECT_TYPES:
-                    active_hours_data[o][hour] += 1
-    return active_hours_data
+                    active_hours_data[o][hour] += weight
+    return {o: [round(count) for count in counts] for o, counts in active_hours_data.items()}
+
+def generate_active_hour_zone_analytics(logs, camera_zones):
+    """ Like generate_active_hour_analytics, per camera and zone: {camera_id: {zone: {object: [24 counts]}}}. """
+    zone_data = {}
+    for video_id, video_log in logs.items():
+        camera_id = utils.get_camera_id(video_id)
+        zones = camera_zones.get(camera_id, CameraZones())
+        for timestamp, detection in iter_detections(video_log):
+            hour = to_datetime(timestamp).hour
+            for d in detection:
+                zone = zones.zone_of(d)
+                if zone is None or d['name'] not in OBJECT_TYPES:
+                    continue
+                counts = zone_data.setdefault(camera_id, {}).setdefault(zone, {o: [0]*24 for o in OBJECT_TYPES})
+                counts[d['name']][hour] += d.get('weight', 1)
+    return {camera_id: {zone: {o: [round(count) for count in counts] for o, counts in zone_counts.items()}
+                        for zone, zone_counts in zones.items()}
+            for camera_id, zones in zone_data.items()}
         
 
 
@@ -44,3 +85,6 @@ if __name__ == "__main__":
 
     active_hours_data = generate_active_hour_analytics(logs)
     utils.write_active_hour_analytics(active_hours_data)
+
+    active_hour_zone_data = generate_active_hour_zone_analytics(logs, load_zones())
+    utils.write_active_hour_zone_analytics(active_hour_zone_data)
@@ -0,0 +1,208 @@
+""" Replays recorded or synthetic video through the pipeline stages as fast as possible.
+
+Usage:
+    python benchmark.py --videos 5                 # latest 5 recordings in static/
+    python benchmark.py --source a.mp4 --source b.mp4
+    python benchmark.py --synthetic 600 --compare benchmarks/<previous>.json
+"""
+import argparse
+import cv2
+from datetime import datetime
+import json
+import logging
+import numpy as np
+from pathlib import Path
+import resource
+import tempfile
+import time
+
+import utils
+from camera_feed import CameraFeed
+from motion_detection import MotionDetector
+from video_utils import VideoWriter
+
+BENCHMARK_DIR = Path('benchmarks')
+STAGES = ('capture', 'motion', 'object', 'json', 'encode')
+FRAME_SIZE = (640, 480)
+
+logger = logging.getLogger(__name__)
+
+class StageStats():
+    def __init__(self):
+        self.latencies = []
+        self.cpu_time = 0.0
+
+    def measure(self):
+        return _StageTimer(self)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        wall_time = sum(latencies)
+        return {
+            'count': len(latencies),
+            'wall_seconds': wall_time,
+            'cpu_seconds': self.cpu_time,
+            'cpu_utilization': self.cpu_time / wall_time if wall_time else 0,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p90_ms': _percentile(latencies, 90) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000 if latencies else 0,
+        }
+
+class _StageTimer():
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.latencies.append(time.perf_counter() - self.start)
+        self.stats.cpu_time += time.thread_time() - self.cpu_start
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux; for RUSAGE_CHILDREN it is that of the largest child
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def _children_cpu_seconds():
+    """ CPU time of child processes, i.e. the ffmpeg encoders, counted once they have exited. """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def generate_synthetic_video(n_frames, output_dir):
+    """ Writes a clip of a noisy static scene with a box wandering through it. """
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=np.uint8)
+    writer = VideoWriter('synthetic', output_dir=output_dir)
+    for i in range(n_frames):
+        frame = background.copy()
+        x = (i * 7) % (FRAME_SIZE[0] - 120)
+        y = (i * 3) % (FRAME_SIZE[1] - 80)
+        cv2.rectangle(frame, (x, y), (x + 120, y + 80), (40, 90, 160), -1)
+        writer.write(frame)
+    writer.release()
+    return output_dir / 'synthetic.mp4'
+
+def run_benchmark(sources, stages, max_frames=None, model_path=None):
+    stats = {stage: StageStats() for stage in STAGES if stage in stages or stage == 'capture'}
+    model = None
+    if 'object' in stages:
+        from object_detection import load_model, MODEL_PATH
+        model = load_model(model_path or MODEL_PATH)
+    rss_after_model_load = _peak_rss_mb()
+
+    n_frames = 0
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for source in sources:
+            camera_feed = CameraFeed(logger, camera_source=str(source))
+            camera_feed.open()
+            motion_detector = MotionDetector(camera_feed, None)
+            motion_detector.set_reference_frame(cv2.resize(camera_feed.get_frame(), FRAME_SIZE))
+            video_writer = VideoWriter(Path(source).stem, output_dir=Path(output_dir)) if 'encode' in stages else None
+
+            while max_frames is None or n_frames < max_frames:
+                with stats['capture'].measure():
+                    frame = camera_feed.read_frame()
+                if frame is None:
+                    break
+                if frame.shape[1::-1] != FRAME_SIZE:
+                    frame = cv2.resize(frame, FRAME_SIZE)
+                n_frames += 1
+
+                if 'motion' in stages:
+                    with stats['motion'].measure():
+                        motion_detector.detect(frame)
+                if model is not None:
+                    with stats['object'].measure():
+                        results = model.track(frame, persist=True, verbose=False)[0]
+                    with stats['json'].measure():
+                        json.loads(results.to_json())
+                if video_writer is not None:
+                    with stats['encode'].measure():
+                        video_writer.write(frame)
+
+            if video_writer is not None:
+                children_cpu = _children_cpu_seconds()
+                with stats['encode'].measure():
+                    video_writer.release()
+                # the encoding itself happens in the ffmpeg child, which has exited once release() returns
+                stats['encode'].cpu_time += _children_cpu_seconds() - children_cpu
+            camera_feed.cap.release()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'timestamp': datetime.now().strftime(utils.DATETIME_FORMAT),
+        'sources': [str(s) for s in sources],
+        'frames': n_frames,
+        'elapsed_seconds': elapsed,
+        'fps': n_frames / elapsed if elapsed else 0,
+        'peak_rss_mb': _peak_rss_mb(),
+        'rss_after_model_load_mb': rss_after_model_load,
+        'encoder_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'stages': {stage: s.report() for stage, s in stats.items()},
+    }
+
+def compare(result, baseline):
+    lines = [f"fps: {baseline['fps']:.1f} -> {result['fps']:.1f} ({_change(baseline['fps'], result['fps'])})"]
+    for stage, report in result['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        old = baseline['stages'][stage]
+        lines.append(f"{stage}: p50 {old['p50_ms']:.2f} -> {report['p50_ms']:.2f} ms ({_change(old['p50_ms'], report['p50_ms'])}), "
+                     f"p99 {old['p99_ms']:.2f} -> {report['p99_ms']:.2f} ms ({_change(old['p99_ms'], report['p99_ms'])})")
+    lines.append(f"peak rss: {baseline['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    if 'encoder_peak_rss_mb' in baseline and 'encoder_peak_rss_mb' in result:
+        lines.append(f"encoder peak rss: {baseline['encoder_peak_rss_mb']:.0f} -> {result['encoder_peak_rss_mb']:.0f} MB")
+    return '\n'.join(lines)
+
+def _change(old, new):
+    if not old:
+        return 'n/a'
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline on recorded or synthetic video.")
+    parser.add_argument('--source', action='append', default=[], help="video file to replay; may be repeated")
+    parser.add_argument('--videos', type=int, default=0, help="replay the N latest recordings from the video directory")
+    parser.add_argument('--synthetic', type=int, default=0, help="replay a generated clip with this many frames")
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--stages', default='motion,object,encode', help="comma-separated subset of motion,object,encode")
+    parser.add_argument('--model', default=None, help="model directory, defaults to the production model")
+    parser.add_argument('--output', default=None, help="result JSON path, defaults to benchmarks/<timestamp>.json")
+    parser.add_argument('--compare', default=None, help="previous result JSON to compare against")
+    args = parser.parse_args()
+
+    stages = set(args.stages.split(','))
+    if 'object' in stages:
+        stages.add('json')
+    sources = [Path(s) for s in args.source]
+    if args.videos:
+        sources += [utils.get_video_path(v) for v in utils.get_video_list(max_videos=args.videos, return_id=True)]
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        if args.synthetic:
+            sources.append(generate_synthetic_video(args.synthetic, Path(synthetic_dir)))
+        if not sources:
+            parser.error("no sources: use --source, --videos or --synthetic")
+        result = run_benchmark(sources, stages, max_frames=args.max_frames, model_path=args.model)
+
+    output_path = Path(args.output) if args.output else BENCHMARK_DIR / f"{result['timestamp']}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open('w') as f:
+        json.dump(result, f, indent=2)
+
+    print(json.dumps(result, indent=2))
+    print(f"saved to {output_path}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(result, json.load(f)))
@@ -0,0 +1,176 @@
+""" Learns motion area thresholds per camera and hour of the day from the motion metrics logged with
+every recording.
+
+A logged motion sample counts as real when an object was detected within --window seconds of it, and
+as noise otherwise. For each camera and hour, the major-motion threshold is the one that rejects the
+most noise while at least --recall of the real motion still reaches it. It never goes below the
+default, which would only let more noise through; the minor threshold keeps the detector's default
+ratio to it. Hours with too few real samples keep the defaults.
+
+Usage:
+    python calibrate_motion.py                  # write data/motion_calibration.json and print the report
+    python calibrate_motion.py --dry-run        # only print the report
+
+The running app picks up a new calibration through POST /motion-config {"reload_calibration": true}.
+"""
+import argparse
+from bisect import bisect_left
+from collections import defaultdict
+import json
+from pathlib import Path
+import time
+
+from analytics import iter_detections, to_datetime
+from track_aggregation import is_motion_record, is_track_record
+import utils
+
+CALIBRATION_PATH = Path('data/motion_calibration.json')
+DEFAULT_MIN_AREA = 500
+DEFAULT_MINOR_AREA = 100
+# samples below this area are stillness, neither real motion nor noise
+NOISE_FLOOR = 50
+
+def load_calibration(camera_id, path=CALIBRATION_PATH):
+    """ {hour: (min_area, minor_area)} of a camera from a calibration file, or {} without one. """
+    if not path.exists():
+        return {}
+    with path.open('r') as f:
+        calibration = json.load(f)
+    hours = calibration.get('cameras', {}).get(camera_id, {}).get('hours', {})
+    return {int(hour): (h['min_area'], h['minor_area']) for hour, h in hours.items() if h.get('calibrated')}
+
+def _detection_spans(video_log):
+    spans = []
+    for timestamp, data in video_log:
+        if is_track_record(data):
+            spans.append((data['start'], data['end']))
+    for timestamp, detections in iter_detections(video_log):
+        if detections:
+            ts = to_datetime(timestamp).timestamp()
+            spans.append((ts, ts))
+    return spans
+
+def _motion_samples(video_log):
+    return [(to_datetime(timestamp).timestamp(), data['contour_area_max'])
+            for timestamp, data in video_log if is_motion_record(data) and 'contour_area_max' in data]
+
+def _is_near(ts, spans, window):
+    return any(start - window <= ts <= end + window for start, end in spans)
+
+def choose_threshold(real_areas, noise_areas, recall, default=DEFAULT_MIN_AREA):
+    """ The threshold of at least default that rejects the most noise while keeping recall of the real
+    areas, preferring the lowest such threshold; default if even that loses too much real motion. """
+    real_areas = sorted(real_areas)
+    noise_areas = sorted(noise_areas)
+
+    def kept(threshold):
+        return (len(real_areas) - bisect_left(real_areas, threshold)) / len(real_areas)
+
+    def rejected(threshold):
+        return bisect_left(noise_areas, threshold) / len(noise_areas) if noise_areas else 0
+
+    candidates = [t for t in set(real_areas) | set(noise_areas) | {default} if t >= default and kept(t) >= recall]
+    if not candidates:
+        return default
+    best = max(rejected(t) for t in candidates)
+    return min(t for t in candidates if rejected(t) == best)
+
+def calibrate(logs, recall=0.95, window=10, min_samples=20, trigger_seconds=10):
+    """ Calibration of each camera that has recordings in logs, keyed by camera id. """
+    by_camera = defaultdict(dict)
+    for video_id, video_log in logs.items():
+        by_camera[utils.get_camera_id(video_id)][video_id] = video_log
+    return {
+        'generated': int(time.time()),
+        'recall': recall,
+        'window': window,
+        'cameras': {camera_id: _calibrate_camera(camera_logs, recall, window, min_samples, trigger_seconds)
+                    for camera_id, camera_logs in sorted(by_camera.items())},
+    }
+
+def _calibrate_camera(logs, recall, window, min_samples, trigger_seconds):
+    real = defaultdict(list)
+    noise = defaultdict(list)
+    recordings = []
+    for video_id, video_log in logs.items():
+        samples = _motion_samples(video_log)
+        if not samples:
+            continue
+        spans = _detection_spans(video_log)
+        for ts, area in samples:
+            if area < NOISE_FLOOR:
+                continue
+            hour = to_datetime(ts).hour
+            (real if _is_near(ts, spans, window) else noise)[hour].append(area)
+        # the motion right after a recording started stands in for the motion that started it
+        start = samples[0][0]
+        trigger_area = max(area for ts, area in samples if ts - start <= trigger_seconds)
+        recordings.append((to_datetime(start).hour, trigger_area, len(spans) > 0))
+
+    hours = {}
+    for hour in range(24):
+        real_areas = sorted(real[hour])
+        noise_areas = noise[hour]
+        entry = {'real_samples': len(real_areas), 'noise_samples': len(noise_areas), 'calibrated': False,
+                 'min_area': DEFAULT_MIN_AREA, 'minor_area': DEFAULT_MINOR_AREA}
+        if len(real_areas) >= min_samples:
+            min_area = round(choose_threshold(real_areas, noise_areas, recall))
+            entry.update(calibrated=True, min_area=min_area,
+                         minor_area=round(min_area * DEFAULT_MINOR_AREA / DEFAULT_MIN_AREA),
+                         recall=round(sum(a >= min_area for a in real_areas) / len(real_areas), 3))
+        if noise_areas:
+            entry['noise_rejected'] = {
+                'default': round(sum(a < DEFAULT_MIN_AREA for a in noise_areas) / len(noise_areas), 3),
+                'calibrated': round(sum(a < entry['min_area'] for a in noise_areas) / len(noise_areas), 3),
+            }
+        hours[hour] = entry
+
+    # a recording is counted as avoidable when its trigger motion stays under its hour's new threshold
+    false_recordings = [(hour, area) for hour, area, has_objects in recordings if not has_objects]
+    true_recordings = [(hour, area) for hour, area, has_objects in recordings if has_objects]
+    avoided = sum(area < hours[hour]['min_area'] for hour, area in false_recordings)
+    at_risk = sum(area < hours[hour]['min_area'] for hour, area in true_recordings)
+    report = {
+        'recordings': len(recordings),
+        'false_recordings': len(false_recordings),
+        'false_recordings_avoided': avoided,
+        'true_recordings_at_risk': at_risk,
+        'expected_false_recording_reduction': round(avoided / len(false_recordings), 3) if false_recordings else 0,
+    }
+    return {'hours': hours, 'report': report}
+
+def read_logs(max_videos):
+    logs = {}
+    for video_id in utils.get_video_list(max_videos=max_videos, return_id=True):
+        video_log = utils.get_video_log(video_id)
+        if video_log is not None:
+            logs[video_id] = video_log
+    return logs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Learn per-hour motion thresholds from recording logs.")
+    parser.add_argument('--recall', type=float, default=0.95, help="share of real motion that must stay above the threshold")
+    parser.add_argument('--window', type=float, default=10, help="seconds between motion and a detection for the motion to count as real")
+    parser.add_argument('--min-samples', type=int, default=20, help="real motion samples an hour needs to be calibrated")
+    parser.add_argument('--max-videos', type=int, default=2000, help="most recent recordings to learn from")
+    parser.add_argument('--dry-run', action='store_true', help="print the report without writing the calibration")
+    args = parser.parse_args()
+
+    calibration = calibrate(read_logs(args.max_videos), args.recall, args.window, args.min_samples)
+    for camera_id, camera in calibration['cameras'].items():
+        print(f"camera {camera_id}:")
+        for hour, entry in camera['hours'].items():
+            if entry['calibrated']:
+                print(f"  {hour:02d}h: min_area {entry['min_area']}, minor_area {entry['minor_area']} "
+                      f"({entry['real_samples']} real, {entry['noise_samples']} noise samples, recall {entry['recall']:.0%}, "
+                      f"noise rejected {entry.get('noise_rejected', {}).get('calibrated', 0):.0%})")
+        report = camera['report']
+        print(f"  {report['false_recordings']} of {report['recordings']} recordings had no detections; "
+              f"{report['false_recordings_avoided']} ({report['expected_false_recording_reduction']:.0%}) would not have been "
+              f"triggered, at the risk of {report['true_recordings_at_risk']} recordings with detections")
+    if not args.dry_run:
+        CALIBRATION_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with CALIBRATION_PATH.open('w') as f:
+            json.dump(calibration, f, indent=2)
+        print(f"wrote {CALIBRATION_PATH}")
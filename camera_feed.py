@@ -1,21 +1,71 @@
 import cv2
+import numpy as np
 import time
 import threading
 import multiprocessing
 
+from metrics import REGISTRY
+from response_cache import RESPONSE_CACHE
+import utils
 from video_utils import VideoWriter
+from zones import CameraZones
+
+# imdecode flags that let libjpeg scale down while decoding, which is much cheaper than decoding and resizing
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
 
 class CameraFeed():
-    def __init__(self, logger, camera_source=0):
+    """ Captures frames from one camera.
+
+    With mjpeg, the camera's own JPEG frames are kept as they are: they are served to livestream viewers
+    and piped to the encoder and the detector without re-encoding, and only decoded, once per frame and
+    scale, when something asks for pixels via get_frame(). Cameras that can't deliver MJPEG fall back to
+    decoded capture, in which case get_jpeg() encodes each frame once for all viewers.
+    """
+    def __init__(self, logger, camera_source=0, camera_id=utils.PRIMARY_CAMERA_ID, mjpeg=False, zones=None):
         self.logger = logger
-        self.cap = cv2.VideoCapture(camera_source)
+        self.camera_id = camera_id
+        self.camera_source = camera_source
+        self.mjpeg = mjpeg
+        # areas of the frame motion and object detection look at
+        self.zones = zones if zones is not None else CameraZones()
+        self.cap = None
+        # set once the camera is opened and warmed up, which start() does in the capture thread
+        self.ready_event = threading.Event()
+        self.warmup_seconds = None
+        # the latest frame as a BGR array and/or as JPEG bytes, whichever is known, and its decoded scales
         self.latest_frame = None
+        self.latest_jpeg = None
+        self.latest_frame_ts = None
+        self.decoded_frames = {}
+        self.frame_seq = 0
         self.is_running = False
         self.is_recording = multiprocessing.Value('i', 0)
+        # set by the motion detector, read by the detection process to prioritize this camera
+        self.last_motion_time = multiprocessing.Value('d', 0)
         self.frame_lock = threading.Lock()
         self.frame_event = threading.Event()
         self.video_writer = None
-        self._clear_first_frames()
+        self.video_id = None
+        # time between decoded frames when not recording; the governor raises it while the scene is static
+        self.frame_interval = 0.05
+        # while recording, frames this long after the last motion are treated as static and mostly left out
+        self.static_after = 3
+        # raised by the memory monitor to shed load: minimum seconds between frames for the detector, and
+        # the quality of JPEGs encoded for viewers
+        self.detector_frame_interval = 0
+        self.default_jpeg_quality = 95
+        self.jpeg_quality = self.default_jpeg_quality
+        self.capture_latency = REGISTRY.histogram('kittycam_capture_seconds', 'Time spent reading a frame from the camera', camera=camera_id)
+        self.frames_captured = REGISTRY.counter('kittycam_frames_captured_total', 'Frames read from the camera', camera=camera_id)
+        self.capture_failures = REGISTRY.counter('kittycam_capture_failures_total', 'Failed camera reads', camera=camera_id)
+        self.frames_to_detector = REGISTRY.counter('kittycam_frames_to_detector_total', 'Frames handed to the object detector process', camera=camera_id)
+        self.jpeg_encode_latency = REGISTRY.histogram('kittycam_stream_jpeg_encode_seconds', 'Time spent JPEG-encoding a frame for livestream viewers', camera=camera_id)
+        self.jpeg_decode_latency = REGISTRY.histogram('kittycam_jpeg_decode_seconds', 'Time spent decoding a camera JPEG for consumers that need pixels', camera=camera_id)
 
         # for object detection only, to pass frame to its process
         self.frame_queue = multiprocessing.Queue()
@@ -23,14 +73,36 @@ class CameraFeed():
     def get_is_recording(self):
         return self.is_recording.value == 1
 
+    def is_ready(self):
+        return self.ready_event.is_set()
+
+    def open(self):
+        """ Opens the camera and discards its first frames. Blocking; start() calls it from the capture thread. """
+        start = time.time()
+        self.cap = cv2.VideoCapture(self.camera_source)
+        if self.mjpeg:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            # hand out the compressed buffer instead of decoding it
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            ret, frame = self.cap.read()
+            if not ret or not _is_jpeg_buffer(frame):
+                self.logger.warning(f"Camera {self.camera_id} does not deliver MJPEG frames; decoding them instead")
+                self.mjpeg = False
+                self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        self._clear_first_frames()
+        self.warmup_seconds = time.time() - start
+        self.ready_event.set()
+
     def _clear_first_frames(self):
         for _ in range(3):
-            ret, self.latest_frame = self.cap.read()
+            frame = self.read_frame()
+            if frame is not None:
+                self._set_latest_frame(frame)
             time.sleep(0.05)
 
     def start(self):
         self.is_running = True
-        self.thread = threading.Thread(target=self._capture_frames)
+        self.thread = threading.Thread(target=self._capture_frames, name=f"capture-{self.camera_id}")
         self.thread.daemon = True
         self.thread.start()
 
@@ -48,39 +120,130 @@ class CameraFeed():
         self.frame_queue.join_thread()
         print("frame queue closed")
 
+    def read_frame(self):
+        """ Reads one frame from the camera source, or returns None if the read failed. """
+        with self.capture_latency.time():
+            ret, frame = self.cap.read()
+        if not ret:
+            self.capture_failures.inc()
+            return None
+        self.frames_captured.inc()
+        if self.mjpeg:
+            # the JPEG as delivered by the camera
+            return frame.tobytes()
+        return frame
+
+    def _set_latest_frame(self, frame, ts=None):
+        with self.frame_lock:
+            self.latest_frame_ts = ts
+            if isinstance(frame, bytes):
+                self.latest_frame, self.latest_jpeg = None, frame
+            else:
+                self.latest_frame, self.latest_jpeg = frame, None
+            self.decoded_frames = {}
+            self.frame_seq += 1
+            self.frame_event.set()
+
     def _capture_frames(self):
+        if not self.is_ready():
+            self.open()
+        next_decode = 0
+        last_to_detector = 0
         while self.is_running:
-            ret, frame = self.cap.read()
-            if ret:
-                with self.frame_lock:
-                    self.latest_frame = frame
-                    self.frame_event.set()
+            if not self.get_is_recording() and time.time() < next_decode:
+                # keep draining the driver's buffer without decoding, so the next decoded frame is current
+                self.cap.grab()
+                time.sleep(0.05)
+                continue
+            next_decode = time.time() + self.frame_interval
+            frame = self.read_frame()
+            if frame is not None:
+                ts = time.time()
+                self._set_latest_frame(frame, ts)
                 if self.get_is_recording():
-                    self.video_writer.write(frame)
-                if self.frame_queue.empty():
-                    self.frame_queue.put(frame)
+                    self.video_writer.write(frame, is_static=ts - self.last_motion_time.value > self.static_after)
+                if self.frame_queue.empty() and ts - last_to_detector >= self.detector_frame_interval:
+                    # timestamp lets the detector measure the cross-process hop
+                    self.frame_queue.put((ts, frame))
+                    self.frames_to_detector.inc()
+                    last_to_detector = ts
             time.sleep(0.05)
 
     def start_recording(self, output_path):
         self.logger.info(f"Recording started for {output_path}")
-        self.video_writer = VideoWriter(output_path)
+        self.video_writer = VideoWriter(output_path, variable_frame_rate=True, mjpeg=self.mjpeg)
+        self.video_id = output_path
         self.is_recording.value = 1
+        RESPONSE_CACHE.invalidate('videos')
 
     def stop_recording(self):
         self.is_recording.value = 0
         self.video_writer.release()
+        self.video_id = None
+        RESPONSE_CACHE.invalidate('videos')
         self.logger.info(f"Recording stopped")
 
     def stream_frame(self):
+        while True:
+            self.frame_event.wait()
+            self.frame_event.clear()
+            yield self.get_frame()
+
+    def stream_jpeg(self):
+        """ Yields (capture ts, JPEG bytes) for each new frame. """
         while True:
             self.frame_event.wait()
             self.frame_event.clear()
             with self.frame_lock:
-                yield self.latest_frame
+                ts = self.latest_frame_ts
+            yield ts, self.get_jpeg()
 
-    def get_frame(self):
+    def get_frame(self, reduce=1):
+        """ The latest frame as a BGR array, optionally reduced by a factor of 2, 4 or 8. """
+        with self.frame_lock:
+            frame, jpeg, seq = self.latest_frame, self.latest_jpeg, self.frame_seq
+            decoded = self.decoded_frames.get(reduce)
+        if decoded is not None:
+            return decoded
+        if frame is not None:
+            if reduce == 1:
+                return frame
+            height, width = frame.shape[:2]
+            decoded = cv2.resize(frame, (width // reduce, height // reduce), interpolation=cv2.INTER_AREA)
+        elif jpeg is not None:
+            with self.jpeg_decode_latency.time():
+                decoded = cv2.imdecode(np.frombuffer(jpeg, np.uint8), REDUCED_DECODE_FLAGS[reduce])
+        else:
+            return None
         with self.frame_lock:
-            return self.latest_frame
+            if self.frame_seq == seq:
+                self.decoded_frames[reduce] = decoded
+        return decoded
+
+    def get_jpeg(self):
+        """ The latest frame as JPEG bytes; encoded at most once per frame when the camera isn't in MJPEG mode. """
+        with self.frame_lock:
+            frame, jpeg, seq = self.latest_frame, self.latest_jpeg, self.frame_seq
+        if jpeg is not None or frame is None:
+            return jpeg
+        with self.jpeg_encode_latency.time():
+            _, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        jpeg = buf.tobytes()
+        with self.frame_lock:
+            if self.frame_seq == seq:
+                self.latest_jpeg = jpeg
+        return jpeg
         
+    def get_frame_buffer_bytes(self):
+        """ Bytes held by the latest frame, as captured and in its decoded and encoded forms. """
+        with self.frame_lock:
+            buffers = [self.latest_frame, *self.decoded_frames.values()]
+            jpeg = self.latest_jpeg
+        return sum(b.nbytes for b in buffers if b is not None) + (len(jpeg) if jpeg is not None else 0)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
+
+def _is_jpeg_buffer(frame):
+    # with CAP_PROP_CONVERT_RGB off, V4L2 returns the compressed frame as a single row of bytes
+    return frame is not None and frame.ndim == 2 and frame.shape[0] == 1
@@ -0,0 +1,135 @@
+""" Keyframe index per recording, and short clips cut from recordings without re-encoding.
+
+An index maps each keyframe's presentation time in the video to the wall-clock time it was captured:
+{'start': wall-clock time of pts 0, 'duration': seconds, 'keyframes': [[pts, wall-clock time], ...]}.
+It is written to logs/keyframes/<id>.json when a recording closes. Merging concatenates the indexes; an
+index older than its video (e.g. after re-encoding) is rebuilt on the next read, carrying the wall-clock
+times over from the old one.
+
+A clip starts at the last keyframe before the requested start, so ffmpeg can copy the stream from
+there instead of decoding and re-encoding, and has faststart set so phones can play it right away.
+
+Usage:
+    python clips.py          # build missing and stale keyframe indexes
+"""
+from bisect import bisect_right
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+import ffmpeg
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+CLIP_DIR = utils.TMP_DIR / 'clips'
+MAX_CACHED_CLIPS = 50
+MAX_CLIP_SECONDS = 60
+
+def probe_keyframes(video_path):
+    """ (duration, [pts of each keyframe]) from the packet flags, which needs no decoding. """
+    probe = ffmpeg.probe(str(video_path), select_streams='v:0', show_entries='packet=pts_time,flags')
+    keyframes = [float(p['pts_time']) for p in probe.get('packets', [])
+                 if 'K' in p.get('flags', '') and p.get('pts_time') not in (None, 'N/A')]
+    return float(probe['format']['duration']), sorted(keyframes)
+
+def _to_wall(index, pts):
+    """ Wall-clock time of pts, measured from the last keyframe of index at or before it. """
+    keyframes = index['keyframes']
+    i = bisect_right([k[0] for k in keyframes], pts) - 1
+    if i < 0:
+        return index['start'] + pts
+    keyframe_pts, keyframe_wall = keyframes[i]
+    return keyframe_wall + pts - keyframe_pts
+
+def _write_index(video_id, index):
+    path = utils.get_keyframe_index_path(video_id)
+    tmp_path = path.with_suffix('.json.tmp')
+    utils.KEYFRAME_DIR.mkdir(parents=True, exist_ok=True)
+    with tmp_path.open('w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+def write_keyframe_index(video_id, start_ts=None, previous=None):
+    """ Indexes a video's keyframes. Wall-clock times come from the previous index of the video if
+    given, else from start_ts, else from the time in the video id. """
+    if start_ts is None:
+        start_ts = datetime.strptime(video_id.split('_')[0], utils.DATETIME_FORMAT).timestamp()
+    duration, keyframes = probe_keyframes(utils.get_video_path(video_id))
+    if previous is None:
+        previous = {'start': start_ts, 'keyframes': []}
+    index = {
+        'start': previous['start'],
+        'duration': duration,
+        'keyframes': [[round(pts, 3), round(_to_wall(previous, pts), 3)] for pts in keyframes],
+    }
+    _write_index(video_id, index)
+    return index
+
+def get_keyframe_index(video_id):
+    """ The video's keyframe index, rebuilt if missing or older than the video. """
+    path = utils.get_keyframe_index_path(video_id)
+    previous = None
+    if path.exists():
+        with path.open('r') as f:
+            previous = json.load(f)
+        if path.stat().st_mtime >= utils.get_video_path(video_id).stat().st_mtime:
+            return previous
+    return write_keyframe_index(video_id, previous=previous)
+
+def _prune_clips():
+    clips = sorted(CLIP_DIR.glob('*.mp4'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in clips[MAX_CACHED_CLIPS:]:
+        path.unlink(missing_ok=True)
+
+def get_clip(video_id, ts, before=5, after=10):
+    """ Path of a clip of the video from before seconds before wall-clock time ts to after seconds after
+    it, cut with stream copy from the keyframe before its start. Clips are cached in CLIP_DIR. """
+    index = get_keyframe_index(video_id)
+    keyframes = index['keyframes']
+    if not keyframes:
+        raise ValueError(f"{video_id} has no keyframes")
+    if not keyframes[0][1] - before <= ts <= _to_wall(index, index['duration']) + after:
+        raise ValueError(f"{ts} is outside of {video_id}")
+    # the last keyframe captured before the clip should start, or the first one
+    i = max(0, bisect_right([wall for _, wall in keyframes], ts - before) - 1)
+    start_pts, start_wall = keyframes[i]
+    duration = min(ts + after - start_wall, index['duration'] - start_pts)
+
+    clip_path = CLIP_DIR / f"{video_id}_{start_pts:.3f}_{duration:.3f}.mp4"
+    if clip_path.exists() and clip_path.stat().st_mtime >= utils.get_video_path(video_id).stat().st_mtime:
+        return clip_path
+    CLIP_DIR.mkdir(parents=True, exist_ok=True)
+    # concurrent requests for the same clip each write their own file
+    tmp_path = clip_path.with_name(f"{clip_path.name}.{threading.get_ident()}.part")
+    try:
+        (
+            ffmpeg
+            .input(str(utils.get_video_path(video_id)), ss=start_pts)
+            .output(str(tmp_path), t=duration, c='copy', format='mp4', movflags='+faststart',
+                    avoid_negative_ts='make_zero')
+            .overwrite_output()
+            .global_args('-loglevel', 'error')
+            .run(capture_stderr=True)
+        )
+        os.replace(tmp_path, clip_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    _prune_clips()
+    return clip_path
+
+
+if __name__ == '__main__':
+    built = 0
+    for video_id in utils.get_video_list(max_videos=None, return_id=True):
+        try:
+            path = utils.get_keyframe_index_path(video_id)
+            if not path.exists() or path.stat().st_mtime < utils.get_video_path(video_id).stat().st_mtime:
+                get_keyframe_index(video_id)
+                built += 1
+        except Exception:
+            logger.exception(f"Failed to index the keyframes of {video_id}")
+    print(f"indexed {built} videos")
@@ -0,0 +1,232 @@
+""" SQLite index of every track in the per-video detection logs, for querying visits across the archive.
+
+VideoLogger adds track records as they are written; sync() picks up logs that were changed or removed
+by anything else (reprocessing, merging, deleting) and backfills old ones.
+
+Usage:
+    python detection_index.py              # index new and changed logs
+    python detection_index.py --rebuild    # re-index everything from scratch
+"""
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from analytics import to_datetime
+from track_aggregation import TrackAggregator, is_track_record
+import utils
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = Path('data/detections.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    video_id TEXT NOT NULL,
+    track_id TEXT,
+    species TEXT NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    confidence REAL NOT NULL,
+    detections INTEGER NOT NULL,
+    day_seconds INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_species_start ON tracks (species, start_ms);
+CREATE INDEX IF NOT EXISTS tracks_start ON tracks (start_ms);
+CREATE INDEX IF NOT EXISTS tracks_video ON tracks (video_id);
+CREATE TABLE IF NOT EXISTS indexed_logs (
+    video_id TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+);
+"""
+
+def iter_track_records(video_log):
+    """ Yields the track records of a log. Per-frame detection lists from older logs are folded into tracks
+    the same way DetectionManager does while recording. """
+    track_aggregator = TrackAggregator()
+    for timestamp, data in video_log:
+        if is_track_record(data):
+            yield data
+        elif isinstance(data, list):
+            ts = to_datetime(timestamp).timestamp()
+            for _, record in track_aggregator.update(ts, data):
+                if is_track_record(record):
+                    yield record
+    for _, record in track_aggregator.flush():
+        yield record
+
+def _to_row(video_id, record):
+    start = datetime.fromtimestamp(record['start'])
+    return (
+        video_id,
+        str(record['track_id']),
+        record['name'],
+        int(record['start'] * 1000),
+        int(record['end'] * 1000),
+        record['duration'],
+        record['confidence']['mean'],
+        record['detections'],
+        start.hour * 3600 + start.minute * 60 + start.second,
+    )
+
+def _log_path(video_id):
+    # same precedence as utils.get_video_log
+    legacy_path = utils.get_video_log_path(video_id, jsonl=False)
+    return legacy_path if legacy_path.exists() else utils.get_video_log_path(video_id)
+
+def _signature(path):
+    st = path.stat()
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def parse_time_of_day(value):
+    """ 'HH:MM' or 'HH:MM:SS' to seconds since midnight. """
+    parts = [int(p) for p in value.split(':')]
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"invalid time of day: {value}")
+    hours, minutes, seconds = (parts + [0])[:3]
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError(f"invalid time of day: {value}")
+    return hours * 3600 + minutes * 60 + seconds
+
+class DetectionIndex():
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # opened lazily so importing this module never touches the disk; callers hold self.lock
+        if self.connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            # readers (the web app) don't block the recording threads' writes, or reprocess/sync runs
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def add_record(self, video_id, record):
+        """ Indexes one record as it is logged; anything but track records is ignored. """
+        if not is_track_record(record):
+            return
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", _to_row(video_id, record))
+
+    def index_video(self, video_id):
+        log_path = _log_path(video_id)
+        video_log = utils.get_video_log(video_id)
+        if video_log is None:
+            self.remove_video(video_id)
+            return 0
+        signature = _signature(log_path)
+        rows = [_to_row(video_id, record) for record in iter_track_records(video_log)]
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM tracks WHERE video_id = ?", (video_id,))
+                connection.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO indexed_logs VALUES (?, ?)", (video_id, signature))
+        return len(rows)
+
+    def remove_video(self, video_id):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM tracks WHERE video_id = ?", (video_id,))
+                connection.execute("DELETE FROM indexed_logs WHERE video_id = ?", (video_id,))
+
+    def sync(self, exclude=(), rebuild=False):
+        """ Re-indexes logs that changed since they were indexed and drops removed ones. Logs in exclude,
+        e.g. of recordings in progress, are left alone; VideoLogger keeps those up to date. """
+        with self.lock:
+            connection = self._connect()
+            if rebuild:
+                with connection:
+                    connection.execute("DELETE FROM tracks")
+                    connection.execute("DELETE FROM indexed_logs")
+            indexed = dict(connection.execute("SELECT video_id, signature FROM indexed_logs"))
+
+        # <id>.<suffix>.jsonl logs written by reprocess.py --suffix are alternatives, not recordings
+        video_ids = set(p.stem for p in utils.VIDEO_LOG_DIR.iterdir()
+                        if p.suffix in ('.json', '.jsonl') and '.' not in p.stem)
+        report = {'indexed': 0, 'removed': 0, 'tracks': 0}
+        for video_id in sorted(set(indexed) - video_ids):
+            self.remove_video(video_id)
+            report['removed'] += 1
+        for video_id in sorted(video_ids - set(exclude)):
+            try:
+                if indexed.get(video_id) == _signature(_log_path(video_id)):
+                    continue
+                report['tracks'] += self.index_video(video_id)
+                report['indexed'] += 1
+            except Exception:
+                logger.exception(f"Failed to index {video_id}")
+        return report
+
+    def query(self, species=None, start_ms=None, end_ms=None, after=None, before=None, min_confidence=None,
+              min_duration=None, limit=1000):
+        """ Tracks matching all given filters, newest first.
+
+        species is a list of names; start_ms and end_ms bound the track start; after and before are a
+        time-of-day window in seconds since midnight, which wraps around midnight when after > before.
+        """
+        conditions, params = [], []
+        if species:
+            conditions.append(f"species IN ({', '.join('?' * len(species))})")
+            params.extend(species)
+        if start_ms is not None:
+            conditions.append("start_ms >= ?")
+            params.append(start_ms)
+        if end_ms is not None:
+            conditions.append("start_ms < ?")
+            params.append(end_ms)
+        if after is not None and before is not None and after > before:
+            conditions.append("(day_seconds >= ? OR day_seconds < ?)")
+            params.extend([after, before])
+        else:
+            if after is not None:
+                conditions.append("day_seconds >= ?")
+                params.append(after)
+            if before is not None:
+                conditions.append("day_seconds < ?")
+                params.append(before)
+        if min_confidence is not None:
+            conditions.append("confidence >= ?")
+            params.append(min_confidence)
+        if min_duration is not None:
+            conditions.append("duration >= ?")
+            params.append(min_duration)
+
+        sql = "SELECT video_id, track_id, species, start_ms, end_ms, duration, confidence FROM tracks"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY start_ms DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [{
+            'video_id': video_id,
+            'track_id': track_id,
+            'species': species,
+            'start': start,
+            'end': end,
+            'duration': duration,
+            'confidence': confidence,
+        } for video_id, track_id, species, start, end, duration, confidence in rows]
+
+
+DETECTION_INDEX = DetectionIndex()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or update the detection index from the per-video logs.")
+    parser.add_argument('--rebuild', action='store_true', help="drop the index and re-index every log")
+    args = parser.parse_args()
+
+    start = time.time()
+    report = DETECTION_INDEX.sync(rebuild=args.rebuild)
+    print(f"indexed {report['indexed']} logs ({report['tracks']} tracks), removed {report['removed']} in {time.time() - start:.1f}s")
@@ -1,64 +1,99 @@
-import cv2
-from datetime import datetime
+import queue
 import time
 import threading
 
 import utils
 from motion_detection import MotionDetector
-from object_detection import ObjectDetector
+from recording_state import RecordingStateMachine, RECORDING, COOLDOWN
+from track_aggregation import TrackAggregator
 from video_utils import VideoLoggerHandler
 
 class DetectionManager():
-    def __init__(self, camera_feed):
+    """ Decides when one camera records. The ObjectDetector is shared between cameras and owned by the caller. """
+    def __init__(self, camera_feed, object_detector, recording_finisher=None, **state_machine_configs):
         self.video_logger_handler = VideoLoggerHandler()
         self.camera_feed = camera_feed
-        self.object_detector = ObjectDetector(self.camera_feed)
-        self.motion_detector = MotionDetector(self.camera_feed, self.video_logger_handler)
+        # (kind, ts, payload) events pushed by the motion detector and the object detector
+        self.events = queue.Queue()
+        self.object_detector = object_detector
+        self.object_detector.subscribe(camera_feed.camera_id, self._on_object_results)
+        # JPEG frames from MJPEG cameras decode much faster at half size, which is plenty for motion
+        self.motion_detector = MotionDetector(self.camera_feed, self.video_logger_handler, self.events,
+                                              reduce=2 if camera_feed.mjpeg else 1)
+        self.state_machine = RecordingStateMachine(**state_machine_configs)
+        self.track_aggregator = TrackAggregator()
+        # builds timelines and keyframe indexes of closed recordings and merges ones split by short gaps
+        self.recording_finisher = recording_finisher
+        self.recording_video_id = None
+        self.recording_start_ts = None
         self.is_running = False
 
     def start(self):
-        self.object_detector.start()
         self.motion_detector.start()
         self.is_running = True
-        self.thread = threading.Thread(target=self._decide_recording)
+        self.thread = threading.Thread(target=self._decide_recording, name=f"recording-{self.camera_feed.camera_id}")
         self.thread.daemon = True
         self.thread.start()
 
+    def _on_object_results(self, ts, objects):
+        self.events.put(('object', ts, objects))
+
     def _decide_recording(self):
         while self.is_running:
-            last_motion_detected_ts = self.motion_detector.last_motion_detection_time
-            last_major_motion_detected_ts = self.motion_detector.last_major_motion_detection_time
-            last_object_detected_ts = self.object_detector.last_detection_time.value
-            ts = time.time()
-            if self.camera_feed.get_is_recording():
-                while not self.object_detector.results_queue.empty():
-                    objd_results = self.object_detector.results_queue.get()
-                    self.video_logger_handler.log(objd_results)
-                if ts-last_object_detected_ts > 10 and ts-last_motion_detected_ts > 5:
-                    self.camera_feed.stop_recording()
-                time.sleep(3)
+            deadline = self.state_machine.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                kind, ts, payload = self.events.get(timeout=timeout)
+            except queue.Empty:
+                kind, ts, payload = 'tick', time.time(), None
+
+            if kind == 'motion':
+                transitions = self.state_machine.on_motion(ts, payload)
+            elif kind == 'object':
+                transitions = self.state_machine.on_object(ts) if len(payload) > 0 else []
+            elif kind == 'tick':
+                transitions = self.state_machine.on_tick(ts)
             else:
-                if ts-last_object_detected_ts < 10 and ts-last_major_motion_detected_ts < 5:
+                continue
+
+            for _, new_state in transitions:
+                if new_state == RECORDING and not self.camera_feed.get_is_recording():
                     self._start_recording()
-                time.sleep(0.5)
-    
+            if transitions and self.state_machine.state not in (RECORDING, COOLDOWN) and self.camera_feed.get_is_recording():
+                self._stop_recording()
+
+            # logged after the transition so the detection that triggered a recording is part of it
+            if kind == 'object' and self.camera_feed.get_is_recording():
+                for record in self.track_aggregator.update(ts, payload):
+                    self.video_logger_handler.log(record)
+
     def _start_recording(self):
-        video_id = datetime.now().strftime(utils.DATETIME_FORMAT)
+        video_id = utils.new_video_id(self.camera_feed.camera_id)
+        self.recording_video_id = video_id
+        self.recording_start_ts = time.time()
+        self.track_aggregator = TrackAggregator()
         self.video_logger_handler.create_logger(video_id)
         self.camera_feed.start_recording(video_id)
 
     def _stop_recording(self):
         self.camera_feed.stop_recording()
+        # logged now, after the motion records written while the tracks were open
+        for record in self.track_aggregator.flush(time.time()):
+            self.video_logger_handler.log(record)
         self.video_logger_handler.close_logger()
+        if self.recording_finisher is not None:
+            self.recording_finisher.on_recording_stopped(self.camera_feed.camera_id, self.recording_video_id,
+                                                         self.recording_start_ts, time.time())
 
+    def get_trace(self):
+        return list(self.state_machine.trace)
 
     def stop(self):
         print("stopping detection manager...")
         self.is_running = False
+        self.events.put(('stop', time.time(), None))
         self.thread.join()
-        self.object_detector.cleanup()
         self.motion_detector.cleanup()
         if self.camera_feed.get_is_recording():
             self._stop_recording()
         print("detection manager stopped")
-
@@ -1,13 +1,22 @@
-import cv2
+from collections import Counter
 from datetime import datetime
-from flask import Flask, Response, request, make_response, send_from_directory, stream_with_context
+from functools import wraps
+from flask import Flask, Response, request, make_response, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
 import logging 
 import os
 import threading
 import utils
 import base64
+import clips
+import ffmpeg
 import json
+from detection_index import DETECTION_INDEX, parse_time_of_day
+from metrics import REGISTRY
+import profiling
+from response_cache import RESPONSE_CACHE, file_signature
+from startup import STARTUP
+import timeline
 
 HOME_IP = os.getenv("HOME_IP")
 
@@ -16,39 +25,119 @@ app = Flask("kitty-cam", static_folder="static")
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 604800
 CORS(app) # TODO: is this correct?
 
+# set by main.py once the capture and detection pipeline is constructed, which happens after the server is up
+app.camera_feeds = {}
+app.camera_feed = None
+app.storage_manager = None
+app.memory_monitor = None
+app.object_detector = None
+app.detection_managers = {}
+app.detection_overlays = {}
+
+FRAMES_STREAMED = REGISTRY.counter('kittycam_stream_frames_total', 'Frames sent to livestream viewers')
+STREAM_VIEWERS = REGISTRY.gauge('kittycam_stream_viewers', 'Connected livestream viewers')
+
 ### API routes  
-def _get_livestream():
-    for frame in app.camera_feed.stream_frame():
-        _, buf = cv2.imencode('.jpg', frame)
+def requires_pipeline(route):
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        if app.camera_feed is None:
+            return {"error": "starting up", "startup": STARTUP.report()}, 503
+        return route(*args, **kwargs)
+    return wrapper
+
+def cached_json(tag, dependencies):
+    """ Serves the route's JSON from RESPONSE_CACHE, keyed by path and query string, with an ETag so
+    unchanged responses become 304s. dependencies(*args, **kwargs) lists the files or directories the
+    response is built from; the entry is rebuilt when any of them changes or the tag is invalidated. """
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = RESPONSE_CACHE.get(key)
+            if entry is None:
+                paths = dependencies(*args, **kwargs)
+                signature = file_signature(paths)
+                body = json.dumps(route(*args, **kwargs)).encode('utf-8')
+                entry = RESPONSE_CACHE.put(key, body, tags=(tag,), dependencies=paths, signature=signature)
+            response = Response(entry.body, mimetype='application/json')
+            response.set_etag(entry.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def _get_camera_feed():
+    return app.camera_feeds.get(request.args.get('camera', utils.PRIMARY_CAMERA_ID), app.camera_feed)
+
+def _recording_video_ids():
+    return set(c.video_id for c in app.camera_feeds.values() if c.get_is_recording())
+
+def _count_viewer(stream):
+    # each viewer is served by its own thread; naming it lets /profile pick out streaming work
+    threading.current_thread().name = f"stream-{threading.get_ident()}"
+    STREAM_VIEWERS.inc()
+    try:
+        yield from stream
+    finally:
+        STREAM_VIEWERS.dec()
+
+def _get_livestream(camera_feed):
+    # the same JPEG is shared by all viewers, and comes straight from the camera in MJPEG mode
+    for _, jpeg in camera_feed.stream_jpeg():
+        FRAMES_STREAMED.inc()
         yield (b'--frame\r\n'
                b'Content-Type: image.jpeg\r\n\r\n'
-               + buf.tobytes() + b'\r\n')
+               + jpeg + b'\r\n')
 
 
-def _get_livestreamr():
-    for frame in app.camera_feed.stream_frame():
-        _, buf = cv2.imencode('.jpg', frame)
-        frame_base64 = base64.b64encode(buf).decode('utf-8')
+def _get_livestreamr(camera_feed):
+    for ts, jpeg in camera_feed.stream_jpeg():
+        FRAMES_STREAMED.inc()
+        frame_base64 = base64.b64encode(jpeg).decode('utf-8')
         data = json.dumps({
             "frame": frame_base64,
-            "is_recording": app.camera_feed.get_is_recording()
+            # matches the ts of /detections updates
+            "ts": None if ts is None else int(ts * 1000),
+            "is_recording": camera_feed.get_is_recording()
         })
         
         yield f"data: {data}\n\n"
 
 @app.route('/livestream')
+@requires_pipeline
 def livestream():
-    return Response(_get_livestream(), mimetype='multipart/x-mixed-replace;boundary=frame')
+    return Response(_count_viewer(_get_livestream(_get_camera_feed())), mimetype='multipart/x-mixed-replace;boundary=frame')
 
 @app.route('/livestreamr')
+@requires_pipeline
 def livestreamr():
-    return Response(stream_with_context(_get_livestreamr()), mimetype='text/event-stream')
+    return Response(stream_with_context(_count_viewer(_get_livestreamr(_get_camera_feed()))), mimetype='text/event-stream')
+
+def _get_detection_updates(overlay):
+    for update in overlay.updates():
+        if update is None:
+            yield ": keepalive\n\n"
+        else:
+            yield f"data: {json.dumps(update)}\n\n"
+
+@app.route('/detections')
+@requires_pipeline
+def detections():
+    """ Live boxes, labels, confidences and track ids for the camera, for the browser to draw over the livestream. """
+    overlay = app.detection_overlays[_get_camera_feed().camera_id]
+    return Response(stream_with_context(_get_detection_updates(overlay)), mimetype='text/event-stream')
+
+@app.route('/cameras')
+def cameras():
+    return [{"camera_id": c.camera_id, "is_recording": c.get_is_recording()} for c in app.camera_feeds.values()]
 
 @app.route('/past-visits')
+@cached_json('videos', lambda: [utils.VIDEO_DIR])
 def past_visists():
     n_videos = int(request.args.get('n', 200))
     prefix = request.args.get('prefix', None)
-    return utils.get_video_list(skip_latest=app.camera_feed.get_is_recording(), max_videos=n_videos, return_id=True, prefix=prefix)
+    return utils.get_video_list(max_videos=n_videos, return_id=True, prefix=prefix, exclude=_recording_video_ids())
 
 def is_user_admin(request):
     user_ip = request.headers.get("X-Forwarded-For", request.remote_addr)
@@ -67,9 +156,41 @@ def video_request(video_id):
         if not is_user_admin(request):
             return {"error": f"Unauthorized"}, 403
         utils.delete_video_by_id(video_id)
+        DETECTION_INDEX.remove_video(video_id)
         return f"deleted {video_id}"
 
+@app.route('/clip/<path:video_id>')
+def clip(video_id):
+    """ A short clip around a moment of a video, e.g. the start_ms of a /query match:
+    /clip/20241102093012?ts=1730536215000&before=5&after=10 (ts in milliseconds, before/after in seconds). """
+    if video_id in _recording_video_ids():
+        return {"error": f"{video_id} is still recording"}, 409
+    if not utils.get_video_path(video_id).exists():
+        return {"error": f"{video_id} not found"}, 404
+    try:
+        ts = int(request.args['ts']) / 1000
+        before = min(float(request.args.get('before', 5)), clips.MAX_CLIP_SECONDS)
+        after = min(float(request.args.get('after', 10)), clips.MAX_CLIP_SECONDS)
+    except KeyError:
+        return {"error": "ts is required"}, 400
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if not before > 0 or not after > 0:
+        return {"error": "before and after must be positive"}, 400
+    try:
+        clip_path = clips.get_clip(video_id, ts, before, after)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except ffmpeg.Error as e:
+        stderr = e.stderr.decode(errors='replace').strip() if e.stderr else ''
+        app.logger.error(f"Failed to cut a clip of {video_id}: {stderr}")
+        return {"error": f"failed to cut a clip of {video_id}"}, 500
+    response = send_file(clip_path.resolve(), mimetype='video/mp4', conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=604800, must-revalidate'
+    return response
+
 @app.route('/favorites')
+@cached_json('favorites', lambda: [utils.FAVORITE_PATH])
 def get_favorites():
     return utils.get_favorites()
 
@@ -88,24 +209,202 @@ def set_favorite(video_id):
 def merge_videos():
     if not is_user_admin(request):
         return {"error": f"Unauthorized"}, 403
-    utils.merge(request.form.getlist('video_to_merge'))
-    return f"merged videos"
+    video_ids = request.form.getlist('video_to_merge')
+    if not video_ids:
+        return {"error": "no videos to merge"}, 400
+    new_video_id = utils.merge(video_ids)
+    for video_id in video_ids:
+        if video_id != new_video_id:
+            DETECTION_INDEX.remove_video(video_id)
+    DETECTION_INDEX.index_video(new_video_id)
+    return f"merged videos into {new_video_id}"
 
 @app.route('/video-log/<path:video_id>')
+@cached_json('videos', lambda video_id: [utils.get_video_log_path(video_id), utils.get_video_log_path(video_id, jsonl=False)])
 def video_log(video_id):
     return utils.get_video_log(video_id)
 
+MAX_TIMELINES = 100
+
+def _timeline_ids():
+    return [video_id for video_id in request.args.get('ids', '').split(',') if video_id][:MAX_TIMELINES]
+
+@app.route('/timelines')
+@cached_json('videos', lambda: [p for video_id in _timeline_ids() for p in (utils.get_video_log_path(video_id), utils.get_video_log_path(video_id, jsonl=False))])
+def timelines():
+    """ Downsampled activity timelines of several videos, e.g. /timelines?ids=20241102093012,20241102101544;
+    null for videos without a log or still recording. """
+    recording = _recording_video_ids()
+    return {video_id: None if video_id in recording else timeline.get_timeline(video_id) for video_id in _timeline_ids()}
+
+def _parse_date(value, end_of_day=False):
+    date = datetime.strptime(value, '%Y-%m-%d')
+    return int(date.timestamp() * 1000) + (24 * 60 * 60 * 1000 if end_of_day else 0)
+
+@app.route('/query')
+def query():
+    """ Visits across all recordings, e.g. /query?species=possum&from=2026-09-01&to=2026-09-30&after=00:00&before=05:00
+
+    from and to are inclusive dates; after and before are a time-of-day window that may wrap around midnight.
+    Timestamps in the response are epoch milliseconds.
+    """
+    try:
+        species = [s for s in request.args.get('species', '').split(',') if s]
+        start_ms = _parse_date(request.args['from']) if 'from' in request.args else None
+        end_ms = _parse_date(request.args['to'], end_of_day=True) if 'to' in request.args else None
+        after = parse_time_of_day(request.args['after']) if 'after' in request.args else None
+        before = parse_time_of_day(request.args['before']) if 'before' in request.args else None
+        min_confidence = float(request.args['min_confidence']) if 'min_confidence' in request.args else None
+        min_duration = float(request.args['min_duration']) if 'min_duration' in request.args else None
+        limit = int(request.args.get('limit', 1000))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    matches = DETECTION_INDEX.query(species, start_ms, end_ms, after, before, min_confidence, min_duration, limit)
+    return {
+        "video_ids": list(dict.fromkeys(m['video_id'] for m in matches)),
+        "matches": matches,
+    }
+
 @app.route('/locations')
 @app.route('/locations/all')
+@cached_json('analytics', lambda: [utils.ANALYTICS_LOCATION_DIR])
 def locations():
     return utils.get_location_analytics()
 
 @app.route('/active-hour')
+@cached_json('analytics', lambda: [utils.ANALYTICS_ACTIVE_HOUR_DIR])
 def active_hour():
     return utils.get_active_hour_analytics()
 
+@app.route('/active-hour/zones')
+@cached_json('analytics', lambda: [utils.ANALYTICS_ACTIVE_HOUR_ZONE_DIR])
+def active_hour_zones():
+    if not utils.ANALYTICS_ACTIVE_HOUR_ZONE_DIR.exists():
+        return {}
+    return utils.get_active_hour_zone_analytics()
+
+@app.route('/storage', methods=['GET', 'POST'])
+@requires_pipeline
+def storage():
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    if request.method == 'POST':
+        # maintenance can re-encode for minutes, so it runs on the manager's thread; poll GET for last_report
+        app.storage_manager.trigger()
+        return {"status": "maintenance scheduled", "last_report": app.storage_manager.last_report}, 202
+    return {"usage": app.storage_manager.get_usage(), "last_report": app.storage_manager.last_report}
+
+@app.route('/memory')
+@requires_pipeline
+def memory():
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    return app.memory_monitor.check()
+
+@app.route('/memory/tracemalloc', methods=['GET', 'POST', 'DELETE'])
+@requires_pipeline
+def memory_tracemalloc():
+    """ POST starts tracing and DELETE stops it; GET returns the top allocation sites and their growth
+    since the last GET. """
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    if request.method == 'POST':
+        return app.memory_monitor.start_tracing()
+    if request.method == 'DELETE':
+        return app.memory_monitor.stop_tracing()
+    report = app.memory_monitor.trace_allocations(top=int(request.args.get('top', 20)))
+    if report is None:
+        return {"error": "not tracing; POST to start", "tracing": False}, 409
+    return report
+
+MOTION_SETTERS = ('blur_size', 'threshold', 'min_area', 'minor_area')
+
+@app.route('/motion-config', methods=['GET', 'POST'])
+@requires_pipeline
+def motion_config():
+    """ Motion detector settings of a camera. POST a JSON object with any of blur_size, threshold, min_area
+    and minor_area to change them, and/or reload_calibration (true to apply data/motion_calibration.json,
+    false to drop per-hour thresholds). Changes apply immediately and last until restart. """
+    from calibrate_motion import load_calibration
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    camera_id = _get_camera_feed().camera_id
+    motion_detector = app.detection_managers[camera_id].motion_detector
+    if request.method == 'POST':
+        configs = request.get_json(force=True)
+        try:
+            values = {key: int(configs[key]) for key in MOTION_SETTERS if key in configs}
+        except (TypeError, ValueError) as e:
+            return {"error": str(e)}, 400
+        if 'blur_size' in values and values['blur_size'] % 2 == 0:
+            return {"error": "blur_size must be odd"}, 400
+        for key, value in values.items():
+            getattr(motion_detector, f"set_{key}")(value)
+        if 'reload_calibration' in configs:
+            motion_detector.set_hourly_areas(load_calibration(camera_id) if configs['reload_calibration'] else {})
+    return motion_detector.get_configs()
+
+@app.route('/profile')
+@requires_pipeline
+def profile():
+    """ Profiles a component for a few seconds, e.g. /profile?component=app&threads=capture-,motion-&seconds=10
+
+    component is 'app' (threads of the web app process, optionally filtered by name prefix: capture-,
+    motion-, recording-, stream-, detector-dispatch, governor, ...) or 'detector' (the detection process).
+    mode is 'sample', or 'cprofile' for the detector. format is 'stats', or 'collapsed' for flame graphs.
+    """
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    component = request.args.get('component', 'app')
+    mode = request.args.get('mode', 'sample')
+    output_format = request.args.get('format', 'stats')
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), profiling.MAX_SECONDS)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if component not in ('app', 'detector') or mode not in ('sample', 'cprofile'):
+        return {"error": "component must be app or detector, mode sample or cprofile"}, 400
+    if component == 'app' and mode == 'cprofile':
+        return {"error": "cprofile only sees its own thread; use mode=sample for the app"}, 400
+
+    if component == 'app':
+        thread_prefixes = [p for p in request.args.get('threads', '').split(',') if p]
+        stacks = profiling.sample_stacks(seconds, thread_prefixes)
+    else:
+        result = app.object_detector.profile(mode, seconds)
+        if result is None:
+            return {"error": "the detector process did not answer in time"}, 504
+        if result.get('busy'):
+            return {"error": "the detector process is already being profiled"}, 409
+        if result['mode'] == 'cprofile':
+            return Response(result['stats'], mimetype='text/plain')
+        stacks = Counter(dict((tuple(stack), count) for stack, count in result['stacks']))
+
+    if output_format == 'collapsed':
+        return Response(profiling.collapsed(stacks), mimetype='text/plain')
+    return profiling.top_functions(stacks)
+
+@app.route('/recording-trace')
+@requires_pipeline
+def recording_trace():
+    if not is_user_admin(request):
+        return {"error": f"Unauthorized"}, 403
+    detection_manager = app.detection_managers[_get_camera_feed().camera_id]
+    state_machine = detection_manager.state_machine
+    return {"state": state_machine.state, "configs": state_machine.get_configs(), "trace": detection_manager.get_trace()}
+
+@app.route('/ready')
+def ready():
+    report = STARTUP.report()
+    return report, 200 if report['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/logs')
 def logs():
+    log_filename = app.config.get('LOG_FILENAME', f"logs/{datetime.now().date()}.log")
     with open(log_filename, 'r') as f:
         log_content = f.read()
     return Response(log_content, mimetype='text/plain')
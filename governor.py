@@ -0,0 +1,159 @@
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = 'active'
+IDLE = 'idle'
+
+THERMAL_ZONE_PATH = Path('/sys/class/thermal/thermal_zone0/temp')
+
+def _process_cpu_seconds(pid):
+    """ User plus system CPU time of a process from /proc, or None where that isn't available. """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # the command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def _read_temperature():
+    try:
+        return int(THERMAL_ZONE_PATH.read_text().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+class Governor():
+    """ Scales the pipeline's work to what is happening in front of the cameras.
+
+    A camera whose scene has been static for idle_after seconds, and that isn't recording, decodes
+    frames every idle_frame_interval seconds and checks for motion every idle_motion_interval seconds;
+    motion or a recording brings it back to full rate on the next check. Independently, while CPU usage
+    of the app, the detector process and the cameras' ffmpeg encoders (as a fraction of all cores) or the
+    SoC temperature exceed their caps, the detector is made to wait longer between inference batches, and
+    the wait is relaxed again once there is headroom.
+    """
+    def __init__(self, object_detector, idle_after=60, active_frame_interval=0.05, idle_frame_interval=0.5,
+                 active_motion_interval=1, idle_motion_interval=2, max_cpu=0.7, max_temperature=75,
+                 max_inference_interval=2.0, check_interval=1):
+        self.object_detector = object_detector
+        self.idle_after = idle_after
+        self.active_frame_interval = active_frame_interval
+        self.idle_frame_interval = idle_frame_interval
+        self.active_motion_interval = active_motion_interval
+        self.idle_motion_interval = idle_motion_interval
+        self.max_cpu = max_cpu
+        self.max_temperature = max_temperature
+        self.max_inference_interval = max_inference_interval
+        self.check_interval = check_interval
+
+        self.cameras = []
+        self.modes = {}
+        # when each camera was added; a camera counts as active for idle_after seconds from then, as if it
+        # had just seen motion, so it starts at full rate
+        self.added_at = {}
+        # CPU seconds of each process at the last check, to take the usage since then from
+        self.last_cpu_seconds = None
+        self.last_check_time = None
+        self.is_running = False
+        self.stop_event = threading.Event()
+
+        self.cpu_usage = REGISTRY.gauge('kittycam_governor_cpu_usage_ratio', 'CPU usage of the app, detector process and encoders as a fraction of all cores')
+        self.temperature = REGISTRY.gauge('kittycam_governor_temperature_celsius', 'SoC temperature seen by the governor')
+        self.inference_interval = REGISTRY.gauge('kittycam_governor_inference_interval_seconds', 'Minimum time between inference batches set by the governor')
+
+    def add_camera(self, camera_feed, motion_detector):
+        self.cameras.append((camera_feed, motion_detector))
+        self.added_at[camera_feed.camera_id] = time.time()
+        self._set_mode(camera_feed, motion_detector, ACTIVE)
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._loop_governor, name="governor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        print("stopping governor...")
+        self.is_running = False
+        self.stop_event.set()
+        self.thread.join()
+        print("governor thread joined")
+
+    def _loop_governor(self):
+        while self.is_running:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Governor check failed")
+            self.stop_event.wait(self.check_interval)
+
+    def check(self):
+        now = time.time()
+        for camera_feed, motion_detector in self.cameras:
+            last_motion_time = max(camera_feed.last_motion_time.value, self.added_at[camera_feed.camera_id])
+            is_active = camera_feed.get_is_recording() or now - last_motion_time < self.idle_after
+            mode = ACTIVE if is_active else IDLE
+            if mode != self.modes[camera_feed.camera_id]:
+                logger.info(f"Camera {camera_feed.camera_id} is {mode}")
+                self._set_mode(camera_feed, motion_detector, mode)
+        self._throttle_inference(now)
+
+    def _set_mode(self, camera_feed, motion_detector, mode):
+        self.modes[camera_feed.camera_id] = mode
+        camera_feed.frame_interval = self.active_frame_interval if mode == ACTIVE else self.idle_frame_interval
+        motion_detector.interval = self.active_motion_interval if mode == ACTIVE else self.idle_motion_interval
+        labels = {'camera': camera_feed.camera_id}
+        REGISTRY.gauge('kittycam_governor_active', 'Whether the governor runs a camera at full rate', **labels).set(int(mode == ACTIVE))
+        REGISTRY.gauge('kittycam_governor_frame_interval_seconds', 'Time between decoded frames set by the governor', **labels).set(camera_feed.frame_interval)
+        REGISTRY.gauge('kittycam_governor_motion_interval_seconds', 'Time between motion checks set by the governor', **labels).set(motion_detector.interval)
+        REGISTRY.counter('kittycam_governor_transitions_total', 'Mode changes made by the governor', mode=mode, **labels).inc()
+
+    def _cpu_seconds(self):
+        """ CPU seconds so far of each process counted against the cap, by pid, or None where that isn't
+        available. Encoders are only counted while recording, as a camera's encoder exits with its recording. """
+        pids = [os.getpid()]
+        process = getattr(self.object_detector, 'process', None)
+        if process is not None and process.pid is not None:
+            pids.append(process.pid)
+        for camera_feed, _ in self.cameras:
+            video_writer = camera_feed.video_writer
+            if video_writer is not None:
+                pids.append(video_writer.process.pid)
+        seconds = {pid: _process_cpu_seconds(pid) for pid in pids}
+        if seconds[os.getpid()] is None:
+            return None
+        # an encoder may have exited since it was listed
+        return {pid: s for pid, s in seconds.items() if s is not None}
+
+    def _throttle_inference(self, now):
+        cpu_seconds = self._cpu_seconds()
+        if cpu_seconds is None:
+            return
+        if self.last_cpu_seconds is None:
+            self.last_cpu_seconds, self.last_check_time = cpu_seconds, now
+            return
+        # an encoder started since the last check counts in full, as it has run only since then
+        used = sum(s - self.last_cpu_seconds.get(pid, 0) for pid, s in cpu_seconds.items())
+        usage = used / max(now - self.last_check_time, 1e-6) / os.cpu_count()
+        self.last_cpu_seconds, self.last_check_time = cpu_seconds, now
+        temperature = _read_temperature()
+        self.cpu_usage.set(round(usage, 3))
+        if temperature is not None:
+            self.temperature.set(temperature)
+
+        interval = self.object_detector.throttle_interval.value
+        too_hot = temperature is not None and temperature > self.max_temperature
+        if usage > self.max_cpu or too_hot:
+            interval = min(self.max_inference_interval, max(0.1, interval * 1.5))
+        elif usage < 0.8 * self.max_cpu and (temperature is None or temperature < self.max_temperature - 5):
+            interval = interval * 0.7 if interval > 0.05 else 0
+        if interval != self.object_detector.throttle_interval.value:
+            self.object_detector.throttle_interval.value = interval
+        self.inference_interval.set(round(interval, 3))
@@ -1,12 +1,112 @@
-import multiprocessing.shared_memory
-from flask_app import app as flask_app
 import atexit
 from datetime import datetime
 import logging
 import multiprocessing
+import multiprocessing.forkserver
+import os
+import threading
 
-from camera_feed import CameraFeed
-from detection_manager import DetectionManager
+from startup import STARTUP
+
+# Modules that load cv2, ultralytics or torch are imported inside start_pipeline(), so the web
+# server does not wait for them. The detector process re-imports this module under forkserver,
+# which is another reason to keep the top level light.
+
+def start_pipeline(flask_app, logger):
+    with STARTUP.phase('pipeline_imports'):
+        from calibrate_motion import load_calibration
+        from camera_feed import CameraFeed
+        from detection_manager import DetectionManager
+        from governor import Governor
+        from memory_budget import MemoryMonitor, MB
+        from object_detection import ObjectDetector
+        from overlay import DetectionOverlay
+        from recording_finisher import RecordingFinisher
+        from storage_manager import StorageManager, GB
+        from zones import load_zones
+        import utils
+
+    # a crash mid-merge leaves a staged merge behind, to complete or roll back before anything merges again
+    utils.recover_merges()
+
+    # One CameraFeed per source, e.g. CAMERA_SOURCES="0,2" or "0,rtsp://yard-cam/stream"; each owns its VideoWriter
+    camera_sources = os.getenv("CAMERA_SOURCES", "0").split(",")
+    # CAMERA_MJPEG=1 keeps the JPEGs of cameras that deliver MJPEG instead of decoding every frame
+    mjpeg = os.getenv("CAMERA_MJPEG", "0") == "1"
+    # detection zones from data/zones.json, keyed by camera id
+    camera_zones = load_zones()
+    camera_feeds = [CameraFeed(logger, int(source) if source.isdigit() else source, camera_id=str(i), mjpeg=mjpeg,
+                               zones=camera_zones.get(str(i)))
+                    for i, source in enumerate(camera_sources)]
+    # A single ObjectDetector process serves all cameras, optionally inferring several frames per forward pass
+    object_detector = ObjectDetector(camera_feeds, batch_size=int(os.getenv("DETECTOR_BATCH_SIZE", 1)),
+                                     batch_timeout=float(os.getenv("DETECTOR_BATCH_TIMEOUT", 0.5)))
+    # finishes closed recordings off the recording threads; COALESCE_GAP=15 also merges a recording into the
+    # previous one if it started within 15 seconds of that one stopping
+    coalesce_gap = os.getenv("COALESCE_GAP")
+    recording_finisher = RecordingFinisher(float(coalesce_gap) if coalesce_gap else None)
+    # DetectionManager owns MotionDetector and VideoLoggerHandler, one per camera
+    detection_managers = {c.camera_id: DetectionManager(c, object_detector, recording_finisher=recording_finisher)
+                          for c in camera_feeds}
+    # per-camera, per-hour motion thresholds learned by calibrate_motion.py, if it has been run
+    for camera_id, detection_manager in detection_managers.items():
+        detection_manager.motion_detector.set_hourly_areas(load_calibration(camera_id))
+    # live detections for livestream viewers, who draw them over the video
+    detection_overlays = {c.camera_id: DetectionOverlay(c.camera_id) for c in camera_feeds}
+    for camera_id, detection_overlay in detection_overlays.items():
+        object_detector.subscribe(camera_id, detection_overlay.publish)
+    # lowers capture and motion-check rates for static scenes and throttles inference to cap CPU usage
+    governor = Governor(object_detector, max_cpu=float(os.getenv("GOVERNOR_MAX_CPU", 0.7)))
+    for camera_feed in camera_feeds:
+        governor.add_camera(camera_feed, detection_managers[camera_feed.camera_id].motion_detector)
+    # MEMORY_BUDGET_MB caps the RSS of the app, detector and encoders combined; over it, detection and streaming shed load
+    memory_budget_mb = os.getenv("MEMORY_BUDGET_MB")
+    memory_monitor = MemoryMonitor(camera_feeds, object_detector, detection_managers,
+                                   max_rss_bytes=float(memory_budget_mb) * MB if memory_budget_mb else None)
+    storage_manager = StorageManager(camera_feeds, max_video_bytes=float(os.getenv("VIDEO_BUDGET_GB", 20)) * GB)
+
+    for camera_feed in camera_feeds:
+        STARTUP.add_component(f"camera-{camera_feed.camera_id}", camera_feed.is_ready, lambda c=camera_feed: c.warmup_seconds)
+    STARTUP.add_component("object-detector", object_detector.is_ready, lambda: object_detector.model_load_seconds.value)
+
+    def cleanup():
+        storage_manager.stop()
+        memory_monitor.stop()
+        governor.stop()
+        for detection_manager in detection_managers.values():
+            detection_manager.stop()
+        recording_finisher.stop()
+        object_detector.cleanup()
+        for camera_feed in camera_feeds:
+            camera_feed.stop()
+
+    # cameras warm up in their capture threads while the detector process loads its model
+    for camera_feed in camera_feeds:
+        camera_feed.start()
+    with STARTUP.phase('detector_process_start'):
+        object_detector.start()
+    recording_finisher.start()
+    for detection_manager in detection_managers.values():
+        detection_manager.start()
+    governor.start()
+    memory_monitor.start()
+    storage_manager.start()
+    atexit.register(cleanup)
+
+    flask_app.camera_feeds = {c.camera_id: c for c in camera_feeds}
+    flask_app.camera_feed = camera_feeds[0]
+    flask_app.storage_manager = storage_manager
+    flask_app.memory_monitor = memory_monitor
+    flask_app.object_detector = object_detector
+    flask_app.detection_managers = detection_managers
+    flask_app.detection_overlays = detection_overlays
+    logger.info(f"Pipeline started: {STARTUP.report()}")
+
+def _start_pipeline_or_log(flask_app, logger):
+    try:
+        start_pipeline(flask_app, logger)
+    except Exception:
+        logger.exception("Pipeline failed to start")
 
 if __name__ == '__main__':
     today = str(datetime.now().date())
@@ -25,21 +125,26 @@ if __name__ == '__main__':
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
+    # The detector process is forked from a server that has already imported ultralytics and torch.
+    # Start the server now so the imports overlap with everything else.
+    start_method = os.getenv("DETECTOR_START_METHOD", "forkserver")
+    multiprocessing.set_start_method(start_method)
+    if start_method == 'forkserver':
+        multiprocessing.set_forkserver_preload(['ultralytics', 'object_detection'])
+        with STARTUP.phase('forkserver_launch'):
+            multiprocessing.forkserver.ensure_running()
 
-    # CameraFeed owns VideoWriter
-    camera_feed = CameraFeed(logger)
-    # DetectionManager owns MotionDetector, ObjectDetector, and VideoLoggerHandler
-    detection_manager = DetectionManager(camera_feed)
+    with STARTUP.phase('web_imports'):
+        from flask_app import app as flask_app
+    STARTUP.add_component("web", lambda: True)
+    # the cameras and the detector register themselves once the pipeline is built; until then, and for
+    # good if building it fails, this keeps the app from reporting ready
+    STARTUP.add_component("pipeline", lambda: flask_app.camera_feed is not None)
 
-    def cleanup():
-        detection_manager.stop()
-        camera_feed.stop()
-
-    atexit.register(cleanup)
+    pipeline_thread = threading.Thread(target=_start_pipeline_or_log, args=(flask_app, logger), name="pipeline-startup")
+    pipeline_thread.daemon = True
+    pipeline_thread.start()
 
-    camera_feed.start()
-    detection_manager.start()
-    
-    flask_app.camera_feed = camera_feed
     flask_app.logger.addHandler(file_handler)
+    flask_app.config['LOG_FILENAME'] = file_handler.baseFilename
     flask_app.run(host='0.0.0.0', port=5000)
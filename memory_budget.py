@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import tracemalloc
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+def process_rss(pid):
+    """ Resident set size of a process in bytes, from /proc; None where that isn't available. """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # multiprocessing queues can't report their size on macOS
+        return None
+
+class MemoryMonitor():
+    """ Accounts for the app's memory and sheds load when it goes over budget.
+
+    Every check_interval seconds it records the RSS of the app, the detector process and the cameras'
+    ffmpeg encoders, the bytes held by each camera's frame buffers, and the depth of the queues between
+    threads and processes. While the combined RSS is above max_rss_bytes, cameras hand frames to the detector at most every
+    shed_detection_interval seconds and encode livestream JPEGs at shed_jpeg_quality. Shedding stops
+    once RSS is back under 90% of the budget.
+    """
+    def __init__(self, camera_feeds, object_detector, detection_managers, max_rss_bytes=None,
+                 shed_detection_interval=2, shed_jpeg_quality=60, check_interval=5):
+        self.camera_feeds = camera_feeds
+        self.object_detector = object_detector
+        self.detection_managers = detection_managers
+        self.max_rss_bytes = max_rss_bytes
+        self.shed_detection_interval = shed_detection_interval
+        self.shed_jpeg_quality = shed_jpeg_quality
+        self.check_interval = check_interval
+
+        self.is_shedding = False
+        self.last_report = None
+        self.last_snapshot = None
+        self.is_running = False
+        self.stop_event = threading.Event()
+        self.shedding = REGISTRY.gauge('kittycam_memory_shedding', 'Whether load is being shed because memory is over budget')
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._loop_monitor, name="memory-monitor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        print("stopping memory monitor...")
+        self.is_running = False
+        self.stop_event.set()
+        self.thread.join()
+        print("memory monitor thread joined")
+
+    def _loop_monitor(self):
+        while self.is_running:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Memory check failed")
+            self.stop_event.wait(self.check_interval)
+
+    def check(self):
+        report = self.get_usage()
+        rss = sum(v for v in report['rss_bytes'].values() if v is not None)
+        if self.max_rss_bytes is not None:
+            if not self.is_shedding and rss > self.max_rss_bytes:
+                logger.warning(f"Memory over budget ({rss // MB} MB > {self.max_rss_bytes // MB} MB), shedding load")
+                self._set_shedding(True)
+            elif self.is_shedding and rss < 0.9 * self.max_rss_bytes:
+                logger.info(f"Memory back under budget ({rss // MB} MB), no longer shedding load")
+                self._set_shedding(False)
+        report['max_rss_bytes'] = self.max_rss_bytes
+        report['shedding'] = self.is_shedding
+        self.last_report = report
+        return report
+
+    def get_usage(self):
+        rss = {'main': process_rss(os.getpid())}
+        process = getattr(self.object_detector, 'process', None)
+        if process is not None and process.pid is not None:
+            rss['object_detector'] = process_rss(process.pid)
+        for c in self.camera_feeds:
+            video_writer = c.video_writer
+            if video_writer is not None:
+                rss[f'encoder-{c.camera_id}'] = process_rss(video_writer.process.pid)
+        for name, value in rss.items():
+            if value is not None:
+                REGISTRY.gauge('kittycam_memory_rss_bytes', 'Resident memory per process', process=name).set(value)
+
+        frame_bytes = {c.camera_id: c.get_frame_buffer_bytes() for c in self.camera_feeds}
+        for camera_id, value in frame_bytes.items():
+            REGISTRY.gauge('kittycam_memory_frame_buffer_bytes', 'Bytes held by a camera\'s latest frame and its decoded and encoded copies', camera=camera_id).set(value)
+
+        depths = {'object_results': queue_depth(self.object_detector.results_queue)}
+        for c in self.camera_feeds:
+            depths[f'frames-{c.camera_id}'] = queue_depth(c.frame_queue)
+        for camera_id, detection_manager in self.detection_managers.items():
+            depths[f'events-{camera_id}'] = detection_manager.events.qsize()
+        for name, depth in depths.items():
+            if depth is not None:
+                REGISTRY.gauge('kittycam_queue_depth', 'Items waiting in a queue between threads or processes', queue=name).set(depth)
+        return {'rss_bytes': rss, 'frame_buffer_bytes': frame_bytes, 'queue_depths': depths}
+
+    def _set_shedding(self, is_shedding):
+        self.is_shedding = is_shedding
+        self.shedding.set(int(is_shedding))
+        for camera_feed in self.camera_feeds:
+            camera_feed.detector_frame_interval = self.shed_detection_interval if is_shedding else 0
+            camera_feed.jpeg_quality = self.shed_jpeg_quality if is_shedding else camera_feed.default_jpeg_quality
+
+    def start_tracing(self):
+        """ Starts tracing allocations, which slows the app down until stop_tracing(). """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.last_snapshot = None
+        return {'tracing': True}
+
+    def trace_allocations(self, top=20):
+        """ Top allocation sites, and the sites that grew most since the previous call; None unless tracing. """
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        report = {
+            'tracing': True,
+            'traced_bytes': current,
+            'peak_traced_bytes': peak,
+            'top': [{'site': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:top]],
+        }
+        if self.last_snapshot is not None:
+            report['growth'] = [{'site': str(stat.traceback), 'bytes': stat.size_diff, 'count': stat.count_diff}
+                                for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:top]]
+        self.last_snapshot = snapshot
+        return report
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self.last_snapshot = None
+        return {'tracing': False}
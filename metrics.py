@@ -0,0 +1,160 @@
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def state(self):
+        return self.value
+
+class Gauge():
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def state(self):
+        return self.value
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def state(self):
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+class _Timer():
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Registry():
+    """ Process-local metrics, rendered in the Prometheus text exposition format. """
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.collectors = []
+        self.remote_snapshots = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(**kwargs)
+                    self.metrics[key] = metric
+                    self.help[name] = (help, cls.kind)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name, help, **labels):
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        """ Registers a callable run before each render, e.g. to pull metrics from another process. """
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """ Picklable copy of all metrics, for shipping from a subprocess to the main process. """
+        with self.lock:
+            items = list(self.metrics.items())
+        return [(name, labels, self.help[name], metric.state()) for (name, labels), metric in items]
+
+    def set_remote_snapshot(self, source, snapshot):
+        self.remote_snapshots[source] = snapshot
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+
+        families = {}
+        for name, labels, help, state in self.snapshot():
+            families.setdefault(name, (help, []))[1].append((labels, state))
+        for snapshot in list(self.remote_snapshots.values()):
+            for name, labels, help, state in snapshot:
+                families.setdefault(name, (help, []))[1].append((labels, state))
+
+        lines = []
+        for name in sorted(families):
+            (help, kind), samples = families[name]
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, state in samples:
+                if kind == 'histogram':
+                    lines.extend(_render_histogram(name, labels, state))
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {state}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def _render_histogram(name, labels, state):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(state['buckets'], state['counts']):
+        cumulative += count
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+    cumulative += state['counts'][-1]
+    lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+    lines.append(f"{name}_sum{_format_labels(labels)} {state['sum']}")
+    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return lines
+
+
+REGISTRY = Registry()
@@ -1,28 +1,41 @@
 import cv2
 import numpy as np
 from collections import deque
+from datetime import datetime
 import threading
 import time
 
+from metrics import REGISTRY
+
 class MotionDetector():
-    def __init__(self, camera_feed, video_logger_handler, blur_size=21, threshold=25, min_area=500):
+    def __init__(self, camera_feed, video_logger_handler, events=None, blur_size=21, threshold=25, min_area=500,
+                 minor_area=100, reduce=1):
         self.blur_size = blur_size
         self.threshold = threshold
+        # contour areas for major motion, which can start a recording, and minor motion, which keeps one going
         self.min_area = min_area
+        self.minor_area = minor_area
+        # {hour: (min_area, minor_area)} learned by calibrate_motion.py; hours not in it use the values above
+        self.hourly_areas = {}
+        # frames are compared at 1/reduce of their size; areas are still reported in full-size pixels
+        self.reduce = reduce
         
         self.camera_feed = camera_feed
         self.video_logger_handler = video_logger_handler
+        self.events = events
         self.is_running = False
+        # seconds between motion checks; the governor raises it while the scene is static
+        self.interval = 1
 
         self.prev_frame_blurred = None
         self.last_major_motion_detection_time = 0
         self.last_motion_detection_time = 0
         self.results_queue = deque(maxlen=30)
+        self.detect_latency = REGISTRY.histogram('kittycam_motion_detect_seconds', 'Time spent computing motion metrics for a frame', camera=camera_feed.camera_id)
 
     def start(self):
-        self.prev_frame_blurred = self._blur(self.camera_feed.get_frame())
         self.is_running = True
-        self.thread = threading.Thread(target=self._loop_detection)
+        self.thread = threading.Thread(target=self._loop_detection, name=f"motion-{self.camera_feed.camera_id}")
         self.thread.daemon = True
         self.thread.start()
 
@@ -33,42 +46,64 @@ class MotionDetector():
         print("motion detector thread joined")
 
     def _loop_detection(self):
+        # the camera may still be warming up
+        while self.is_running and not self.camera_feed.ready_event.wait(timeout=0.5):
+            pass
+        if self.is_running:
+            self.set_reference_frame(self.camera_feed.get_frame(self.reduce))
         while self.is_running:
-            ts = int(time.time())
-            results = self.detect(self.camera_feed.get_frame())
+            ts = time.time()
+            with self.detect_latency.time():
+                results = self.detect(self.camera_feed.get_frame(self.reduce))
             self.results_queue.append((ts, results))
-            if results['contour_area_max'] >= 500:
+            min_area, minor_area = self.get_area_thresholds(ts)
+            if results['contour_area_max'] >= min_area:
                 self.last_major_motion_detection_time = ts
                 self.last_motion_detection_time = ts
-            elif results['contour_area_max'] >= 100:
+                self._push_event(ts, is_major=True)
+            elif results['contour_area_max'] >= minor_area:
                 self.last_motion_detection_time = ts
+                self._push_event(ts, is_major=False)
             if self.camera_feed.get_is_recording():
                 self.video_logger_handler.log((ts, results))
-            time.sleep(1)
+            time.sleep(self.interval)
+
+    def _push_event(self, ts, is_major):
+        self.camera_feed.last_motion_time.value = ts
+        if self.events is not None:
+            self.events.put(('motion', ts, is_major))
 
+    def set_reference_frame(self, frame):
+        self.prev_frame_blurred = self._blur(frame)
 
     def _blur(self, frame):
-        frame = frame.copy()
-        # TODO: is the original frame modified?
+        # cvtColor writes to a new array, so the shared frame isn't modified and needs no copy
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        return cv2.GaussianBlur(gray, (self.blur_size, self.blur_size), 0)
+        # kernel sizes must be odd
+        blur_size = max(3, (self.blur_size // self.reduce) | 1)
+        return cv2.GaussianBlur(gray, (blur_size, blur_size), 0)
     
     def detect(self, frame):
         blurred_frame = self._blur(frame)
         raw_delta = cv2.absdiff(self.prev_frame_blurred, blurred_frame)
         self.prev_frame_blurred = blurred_frame
+        mask = self.camera_feed.zones.mask(raw_delta.shape[1], raw_delta.shape[0])
+        if mask is not None:
+            # changes outside the include zones, or inside exclude zones, don't count as motion
+            raw_delta = cv2.bitwise_and(raw_delta, raw_delta, mask=mask)
 
         threshold_delta = cv2.threshold(raw_delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
         dilated_delta = cv2.dilate(threshold_delta, None, iterations=2)
         contours, _ = cv2.findContours(dilated_delta.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
+        area_scale = self.reduce ** 2
         metrics = {
             'raw_delta_mean_change': np.mean(raw_delta),
             'raw_delta_max_change': float(np.max(raw_delta)),
             'raw_delta_percent_change': (raw_delta > self.threshold).mean() * 100,
-            'contour_area_total': sum(cv2.contourArea(c) for c in contours),
+            'contour_area_total': sum(cv2.contourArea(c) for c in contours) * area_scale,
             'contour_count': len(contours),
-            'contour_area_max': 0 if len(contours) == 0 else max(cv2.contourArea(c) for c in contours)
+            'contour_area_max': 0 if len(contours) == 0 else max(cv2.contourArea(c) for c in contours) * area_scale
         }
 
         return metrics
@@ -81,6 +116,18 @@ class MotionDetector():
 
     def set_min_area(self, min_area):
         self.min_area = min_area
+
+    def set_minor_area(self, minor_area):
+        self.minor_area = minor_area
+
+    def set_hourly_areas(self, hourly_areas):
+        self.hourly_areas = dict(hourly_areas)
+
+    def get_area_thresholds(self, ts):
+        """ (min_area, minor_area) in effect at ts. """
+        return self.hourly_areas.get(datetime.fromtimestamp(ts).hour, (self.min_area, self.minor_area))
     
     def get_configs(self):
-        return {"blur_size": self.blur_size, "threshold": self.threshold, "min_area": self.min_area}
+        return {"blur_size": self.blur_size, "threshold": self.threshold, "min_area": self.min_area,
+                "minor_area": self.minor_area,
+                "hourly_areas": {hour: {"min_area": a, "minor_area": b} for hour, (a, b) in sorted(self.hourly_areas.items())}}
@@ -1,40 +1,310 @@
-from ultralytics import YOLO
+from collections import namedtuple
 import json
 import multiprocessing
-from collections import deque
+from pathlib import Path
+import queue
+import threading
 import time
 
+import metrics
+from metrics import REGISTRY
+from profiling import ProcessProfiler
+
+METRICS_PUSH_INTERVAL = 5
+MODEL_PATH = "finetuned_ncnn_model"
+TRACKER_CONFIG = "botsort.yaml"
+# frames waiting longer than this in a camera's queue are dropped in favour of the next, fresh one
+MAX_FRAME_AGE = 0.5
+RESULTS_QUEUE_SIZE = 100
+
+# per-camera state shared with the detection process
+CameraChannel = namedtuple('CameraChannel', ['camera_id', 'frame_queue', 'is_recording', 'last_motion_time', 'zones'])
+
+def load_model(model_path=MODEL_PATH):
+    # imported here so that only the detection process pays for loading ultralytics and torch
+    from ultralytics import YOLO
+    return YOLO(model_path)
+
+def get_export_batch_size(model_path=MODEL_PATH):
+    """ Batch size an exported model was built for; models without export metadata take any batch. """
+    from ultralytics.utils import yaml_load
+    metadata_path = Path(model_path) / 'metadata.yaml'
+    if not metadata_path.exists():
+        return None
+    return yaml_load(metadata_path).get('batch', 1)
+
+def predict_batch(model, frames, export_batch_size):
+    """ Runs frames through the model in as few forward passes as the exported model allows. """
+    step = len(frames) if export_batch_size is None else max(1, export_batch_size)
+    results = []
+    for i in range(0, len(frames), step):
+        results.extend(model.predict(frames[i:i + step], verbose=False))
+    return results
+
+def to_image(frame):
+    """ Frames arrive as BGR arrays, or as JPEG bytes from cameras in MJPEG passthrough mode. """
+    if isinstance(frame, bytes):
+        import cv2
+        import numpy as np
+        return cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+    return frame
+
+def crop_to_zones(image, zones):
+    """ Crops a frame to the bounding box of its camera's include zones; returns the crop and its offset. """
+    height, width = image.shape[:2]
+    box = zones.crop_box(width, height)
+    if box is None:
+        return image, (0, 0)
+    x1, y1, x2, y2 = box
+    return image[y1:y2, x1:x2], (x1, y1)
+
+def offset_boxes(objects, offset):
+    """ Moves boxes found in a crop back into the coordinates of the full frame. """
+    dx, dy = offset
+    if dx == 0 and dy == 0:
+        return objects
+    for o in objects:
+        box = o['box']
+        box.update(x1=box['x1'] + dx, x2=box['x2'] + dx, y1=box['y1'] + dy, y2=box['y2'] + dy)
+    return objects
+
+def new_tracker():
+    """ A standalone tracker, so cameras sharing one model don't share track state. """
+    from ultralytics.trackers.track import TRACKER_MAP
+    from ultralytics.utils import IterableSimpleNamespace, yaml_load
+    from ultralytics.utils.checks import check_yaml
+    cfg = IterableSimpleNamespace(**yaml_load(check_yaml(TRACKER_CONFIG)))
+    return TRACKER_MAP[cfg.tracker_type](args=cfg, frame_rate=30)
+
+def track(tracker, results):
+    """ Assigns track ids to a frame's predictions, like model.track(persist=True) does with its own tracker. """
+    import torch
+    det = results.boxes.cpu().numpy()
+    if len(det) == 0:
+        return results
+    tracks = tracker.update(det, results.orig_img)
+    if len(tracks) == 0:
+        return results
+    results = results[tracks[:, -1].astype(int)]
+    results.update(boxes=torch.as_tensor(tracks[:, :-1]))
+    return results
+
+class FrameScheduler():
+    """ Picks the camera the shared detector looks at next.
+
+    Cameras that are recording or saw motion recently are inspected every active_interval seconds and
+    take precedence over idle ones, which are inspected every idle_interval seconds. Ties are broken
+    round-robin so a busy camera cannot starve the others. Batching never samples a camera more often
+    than its interval; a batch only gathers frames that are due anyway, from different cameras.
+    """
+    def __init__(self, cameras, active_interval=1, idle_interval=3, motion_window=5):
+        self.cameras = cameras
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.motion_window = motion_window
+        self.next_due = [0] * len(cameras)
+        self.rotation = 0
+
+    def _is_active(self, camera, now):
+        return camera.is_recording.value == 1 or now - camera.last_motion_time.value < self.motion_window
+
+    def _interval(self, camera, now):
+        return self.active_interval if self._is_active(camera, now) else self.idle_interval
+
+    def next_frame(self, is_running, deadline=None):
+        """ Blocks until a camera is due and has a fresh frame; returns (camera, ts, frame), or None once
+        stopped or past the deadline. """
+        n = len(self.cameras)
+        while is_running.value == 1:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return None
+            order = [(self.rotation + i) % n for i in range(n)]
+            order.sort(key=lambda i: not self._is_active(self.cameras[i], now))
+            for i in order:
+                if now < self.next_due[i]:
+                    continue
+                camera = self.cameras[i]
+                try:
+                    ts, frame = camera.frame_queue.get_nowait()
+                except queue.Empty:
+                    continue
+                if now - ts > MAX_FRAME_AGE:
+                    continue
+                self.next_due[i] = now + self._interval(camera, now)
+                self.rotation = (i + 1) % n
+                return camera, ts, frame
+            time.sleep(min(0.05, max(0.005, min(self.next_due) - now)))
+        return None
+
+    def next_batch(self, is_running, batch_size, batch_timeout):
+        """ Waits for a first frame, then collects frames of other cameras that come due until the batch is
+        full or batch_timeout has passed. """
+        first = self.next_frame(is_running)
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.time() + batch_timeout
+        while len(batch) < batch_size:
+            item = self.next_frame(is_running, deadline)
+            if item is None:
+                break
+            batch.append(item)
+        return batch
+
 class ObjectDetector():
-    def __init__(self, camera_feed):
-        self.camera_feed = camera_feed
+    """ One detection process shared by all cameras.
+
+    With batch_size > 1, frames are collected for up to batch_timeout seconds and inferred together.
+    """
+    def __init__(self, camera_feeds, batch_size=1, batch_timeout=0.5):
+        self.camera_feeds = camera_feeds
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
         self.is_running = multiprocessing.Value('i', 1)
-        self.results_queue = multiprocessing.Queue()
-        self.last_detection_time = multiprocessing.Value('i', 0)
-    
+        # set by the detection process once the model is loaded; negative until then
+        self.model_load_seconds = multiprocessing.Value('d', -1)
+        # minimum seconds between inference batches, raised by the governor to cap CPU usage
+        self.throttle_interval = multiprocessing.Value('d', 0)
+        # (camera_id, ts, objects) from the detection process; bounded so a stalled consumer can't grow it forever
+        self.results_queue = multiprocessing.Queue(maxsize=RESULTS_QUEUE_SIZE)
+        # metric snapshots pushed from the detection process
+        self.metrics_queue = multiprocessing.Queue()
+        # profile requests to the detection process and their results, see profile()
+        self.profile_control_queue = multiprocessing.Queue()
+        self.profile_result_queue = multiprocessing.Queue()
+        self.profile_lock = threading.Lock()
+        self.profile_token = 0
+        self.subscribers = {}
+        REGISTRY.add_collector(self._collect_metrics)
+
+    def subscribe(self, camera_id, callback):
+        """ Calls callback(ts, objects) with each detection result for the camera. """
+        self.subscribers.setdefault(camera_id, []).append(callback)
+
     def start(self):
-        self.process = multiprocessing.Process(target=self._loop_detection, args=(self.camera_feed.frame_queue, self.camera_feed.is_recording, self.last_detection_time, self.is_running, self.results_queue))
+        cameras = [CameraChannel(c.camera_id, c.frame_queue, c.is_recording, c.last_motion_time, c.zones) for c in self.camera_feeds]
+        self.process = multiprocessing.Process(target=_loop_detection, name="object-detector", args=(cameras, self.batch_size, self.batch_timeout, self.is_running, self.model_load_seconds, self.throttle_interval, self.results_queue, self.metrics_queue, self.profile_control_queue, self.profile_result_queue))
         self.process.daemon = True
         self.process.start()
+        self.dispatch_thread = threading.Thread(target=self._dispatch_results, name="detector-dispatch")
+        self.dispatch_thread.daemon = True
+        self.dispatch_thread.start()
+
+    def is_ready(self):
+        return self.model_load_seconds.value >= 0
+
+    def profile(self, mode, seconds):
+        """ Profiles the detection process for seconds ('sample' or 'cprofile') and returns the result,
+        {'busy': True} if a profile is already running there, or None if it didn't arrive in time. Blocks,
+        so call it from a request thread. """
+        # one caller waits on the result queue at a time; others are told the profiler is busy right away
+        if not self.profile_lock.acquire(blocking=False):
+            return {'busy': True}
+        try:
+            self.profile_token += 1
+            token = self.profile_token
+            self.profile_control_queue.put((token, mode, seconds))
+            # the request is only picked up between batches
+            deadline = time.time() + seconds + 30
+            while True:
+                try:
+                    result = self.profile_result_queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    return None
+                # results of earlier requests that timed out arrive late; they are nobody's anymore
+                if result['token'] == token:
+                    return result
+        finally:
+            self.profile_lock.release()
 
     def cleanup(self):
         print("stopping object detector...")
         self.is_running.value = 0
         self.process.join()
+        self.dispatch_thread.join()
         print("object detector process joined")
 
-    def _loop_detection(self, frame_queue, is_recording, last_detection_time, is_running, detection_results_queue):
-        model = YOLO("finetuned_ncnn_model")
-        while is_running.value == 1:
-            frame = frame_queue.get()
-            if frame is None:
-                break
-            ts = int(time.time())
-            results = model.track(frame, persist=True)[0]
-            objects = json.loads(results.to_json())
-            if len(objects) > 0:
-                last_detection_time.value = ts
-            if not is_recording.value:
-                time.sleep(3)
-            else:
-                time.sleep(1)
-                detection_results_queue.put((ts,objects))
+    def _dispatch_results(self):
+        while self.is_running.value == 1:
+            try:
+                camera_id, ts, objects = self.results_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            for callback in self.subscribers.get(camera_id, []):
+                callback(ts, objects)
+
+    def _collect_metrics(self):
+        snapshot = None
+        try:
+            while True:
+                snapshot = self.metrics_queue.get_nowait()
+        except queue.Empty:
+            pass
+        if snapshot is not None:
+            REGISTRY.set_remote_snapshot('object_detector', snapshot)
+
+def _loop_detection(cameras, batch_size, batch_timeout, is_running, model_load_seconds, throttle_interval, detection_results_queue, metrics_queue, profile_control_queue, profile_result_queue):
+    """ Body of the detection process. A module-level function so it can be started via forkserver. """
+    # a forked REGISTRY would hold the parent's metrics, so keep this process's own
+    registry = metrics.Registry()
+    # losing the last snapshot at shutdown is fine; don't block exit on it
+    metrics_queue.cancel_join_thread()
+    queue_wait = registry.histogram('kittycam_detector_queue_wait_seconds', 'Time from frame capture until the detector picks it up')
+    inference_latency = registry.histogram('kittycam_detector_inference_seconds', 'Time spent in model inference and tracking per batch')
+    json_latency = registry.histogram('kittycam_detector_json_seconds', 'Time spent converting results to JSON')
+    batch_sizes = registry.histogram('kittycam_detector_batch_size', 'Frames per inference batch', buckets=tuple(range(1, batch_size + 1)))
+    throttle_wait = registry.counter('kittycam_detector_throttle_seconds_total', 'Time the detector waited because of the governor')
+    last_metrics_push = 0
+    profiler = ProcessProfiler(profile_control_queue, profile_result_queue)
+
+    load_start = time.time()
+    model = load_model()
+    model_load_seconds.value = time.time() - load_start
+    export_batch_size = get_export_batch_size()
+    if batch_size > 1 and export_batch_size is not None and export_batch_size < batch_size:
+        print(f"model was exported with batch={export_batch_size}; batches of {batch_size} run in several passes")
+    trackers = {camera.camera_id: new_tracker() for camera in cameras}
+    # whether a camera's last result had objects, so the empty result after it clears live overlays
+    had_objects = {camera.camera_id: False for camera in cameras}
+    scheduler = FrameScheduler(cameras)
+    while True:
+        batch = scheduler.next_batch(is_running, batch_size, batch_timeout)
+        if not batch:
+            break
+        now = time.time()
+        for _, ts, _ in batch:
+            queue_wait.observe(now - ts)
+        batch_sizes.observe(len(batch))
+        images = [to_image(frame) for _, _, frame in batch]
+        frame_sizes = [(image.shape[1], image.shape[0]) for image in images]
+        crops = [crop_to_zones(image, camera.zones) for (camera, _, _), image in zip(batch, images)]
+        with inference_latency.time():
+            predictions = predict_batch(model, [crop for crop, _ in crops], export_batch_size)
+            # batch order is capture order per camera, so trackers see each camera's frames in sequence
+            predictions = [track(trackers[camera.camera_id], p) for (camera, _, _), p in zip(batch, predictions)]
+
+        for (camera, ts, _), results, (_, offset), frame_size in zip(batch, predictions, crops, frame_sizes):
+            with json_latency.time():
+                objects = offset_boxes(json.loads(results.to_json()), offset)
+            in_zone = [o for o in objects if camera.zones.contains(o, frame_size)]
+            registry.counter('kittycam_detector_out_of_zone_total', 'Objects discarded for being outside the detection zones', camera=camera.camera_id).inc(len(objects) - len(in_zone))
+            objects = in_zone
+            registry.counter('kittycam_detector_frames_total', 'Frames processed by the object detector', camera=camera.camera_id).inc()
+            registry.counter('kittycam_detector_objects_total', 'Objects found by the object detector', camera=camera.camera_id).inc(len(objects))
+            # results are timestamped with the frame's capture time; empty ones only matter for the recording
+            # log and for clearing live overlays
+            if len(objects) > 0 or camera.is_recording.value or had_objects[camera.camera_id]:
+                try:
+                    detection_results_queue.put_nowait((camera.camera_id, ts, objects))
+                except queue.Full:
+                    registry.counter('kittycam_detector_results_dropped_total', 'Results dropped because the results queue was full', camera=camera.camera_id).inc()
+            had_objects[camera.camera_id] = len(objects) > 0
+        if time.time() - last_metrics_push > METRICS_PUSH_INTERVAL and metrics_queue.empty():
+            metrics_queue.put(registry.snapshot())
+            last_metrics_push = time.time()
+        profiler.poll()
+        wait = throttle_interval.value - (time.time() - now)
+        if wait > 0:
+            time.sleep(wait)
+            throttle_wait.inc(wait)
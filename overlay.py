@@ -0,0 +1,41 @@
+import threading
+
+class DetectionOverlay():
+    """ Latest detections of one camera, for livestream viewers to draw over the video themselves.
+
+    Each update carries the capture timestamp of the frame it was detected in, in milliseconds, which
+    the /livestreamr frames carry as well.
+    """
+    def __init__(self, camera_id):
+        self.camera_id = camera_id
+        self.latest = None
+        self.seq = 0
+        self.condition = threading.Condition()
+
+    def publish(self, ts, objects):
+        update = {
+            'camera': self.camera_id,
+            'ts': int(ts * 1000),
+            'objects': [{
+                'name': o['name'],
+                'confidence': round(o['confidence'], 3),
+                'track_id': o.get('track_id'),
+                'box': {k: round(v, 1) for k, v in o['box'].items()},
+            } for o in objects],
+        }
+        with self.condition:
+            self.latest = update
+            self.seq += 1
+            self.condition.notify_all()
+
+    def updates(self, keepalive=15):
+        """ Yields each new update, starting with the current one, or None every keepalive seconds without one. """
+        seen = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.seq != seen, timeout=keepalive)
+                if self.seq == seen:
+                    update = None
+                else:
+                    seen, update = self.seq, self.latest
+            yield update
@@ -0,0 +1,107 @@
+""" On-demand, time-bounded profiling. Nothing is installed or running until a profile is requested.
+
+Sampling walks the stacks of the selected threads every few milliseconds, and can be rendered as
+collapsed stacks (one "thread;outer;...;inner count" line per stack, the input format of flamegraph.pl
+and speedscope) or as a table of functions. cProfile is deterministic but only sees the thread it runs
+in, so it is offered for the detector process, whose work happens on its main thread.
+"""
+from collections import Counter
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 60
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds, thread_prefixes=None, interval=SAMPLE_INTERVAL):
+    """ Counts the stacks of threads whose names start with one of thread_prefixes (all threads if None),
+    keyed by (thread name, outermost frame, ..., innermost frame). """
+    prefixes = tuple(thread_prefixes) if thread_prefixes else None
+    own_ident = threading.get_ident()
+    stacks = Counter()
+    deadline = time.time() + min(seconds, MAX_SECONDS)
+    while time.time() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, str(ident))
+            if ident == own_ident or (prefixes and not name.startswith(prefixes)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stacks[(name, *reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+def collapsed(stacks):
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+def top_functions(stacks, top=30):
+    """ Functions by samples spent in them (self) and under them (total). """
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in stacks.items():
+        self_counts[stack[-1]] += count
+        for label in set(stack[1:]):
+            total_counts[label] += count
+    n_samples = sum(stacks.values())
+    return {
+        'samples': n_samples,
+        'functions': [{'function': label, 'total': total, 'self': self_counts[label],
+                       'total_share': round(total / n_samples, 3)}
+                      for label, total in total_counts.most_common(top)],
+    }
+
+def cprofile_text(profile, top=30):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(top)
+    return out.getvalue()
+
+class ProcessProfiler():
+    """ Serves profile requests from a control queue inside a subprocess.
+
+    The subprocess calls poll() from its main loop; while no profile is requested that is one check of
+    an empty queue. Requests are (token, mode, seconds); results are put on result_queue with the
+    request's token as {'token', 'mode': 'sample', 'stacks': [...]}, {'token', 'mode': 'cprofile',
+    'stats': text}, or {'token', 'busy': True} right away while a profile is already running.
+    """
+    def __init__(self, control_queue, result_queue):
+        self.control_queue = control_queue
+        self.result_queue = result_queue
+        self.profile = None
+        self.profile_token = None
+        self.deadline = None
+        self.sampler = None
+
+    def poll(self):
+        if self.profile is not None and time.time() >= self.deadline:
+            self.profile.disable()
+            self.result_queue.put({'token': self.profile_token, 'mode': 'cprofile', 'stats': cprofile_text(self.profile)})
+            self.profile = None
+        if self.control_queue.empty():
+            return
+        token, mode, seconds = self.control_queue.get()
+        seconds = min(seconds, MAX_SECONDS)
+        if self.profile is not None or (self.sampler is not None and self.sampler.is_alive()):
+            self.result_queue.put({'token': token, 'busy': True})
+        elif mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile_token = token
+            self.deadline = time.time() + seconds
+            self.profile.enable()
+        elif mode == 'sample':
+            main_thread = threading.main_thread().name
+            self.sampler = threading.Thread(target=self._sample, args=(token, seconds, [main_thread]), name="profiler", daemon=True)
+            self.sampler.start()
+
+    def _sample(self, token, seconds, thread_prefixes):
+        stacks = sample_stacks(seconds, thread_prefixes)
+        self.result_queue.put({'token': token, 'mode': 'sample', 'stacks': list(stacks.items())})
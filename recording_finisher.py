@@ -0,0 +1,80 @@
+import logging
+import queue
+import threading
+
+import clips
+from detection_index import DETECTION_INDEX
+from metrics import REGISTRY
+import timeline
+import utils
+
+logger = logging.getLogger(__name__)
+
+class RecordingFinisher():
+    """ Does the work due once a recording is closed, off the recording threads so they keep handling
+    motion and object events: builds the recording's timeline and keyframe index, and with max_gap set,
+    merges it into the previous recording from the same camera if it started less than max_gap seconds
+    after that one stopped, so a cat stepping out of view for a moment leaves one visit, not two.
+
+    Jobs run one at a time in the order recordings closed. A chain of short gaps ends up in a single
+    video, named after the first recording.
+    """
+    def __init__(self, max_gap=None):
+        self.max_gap = max_gap
+        # camera id -> (video id the next recording would merge into, when that visit stopped)
+        self.last_recordings = {}
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.is_running = False
+        self.coalesced = REGISTRY.counter('kittycam_recordings_coalesced_total', 'Recordings merged into the previous one from the same camera')
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._loop_jobs, name="recording-finisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        print("stopping recording finisher...")
+        self.is_running = False
+        # jobs already queued run before the sentinel
+        self.jobs.put(None)
+        self.thread.join()
+        print("recording finisher thread joined")
+
+    def on_recording_stopped(self, camera_id, video_id, start_ts, stop_ts):
+        with self.lock:
+            # indexed before any merge, which combines the keyframe indexes of the merged videos
+            self.jobs.put((self._derive, video_id, start_ts))
+            previous = self.last_recordings.get(camera_id)
+            if self.max_gap is not None and previous is not None and start_ts - previous[1] < self.max_gap:
+                self.jobs.put((self._merge, previous[0], video_id))
+                self.last_recordings[camera_id] = (previous[0], stop_ts)
+            else:
+                self.last_recordings[camera_id] = (video_id, stop_ts)
+
+    def _loop_jobs(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            function, *args = job
+            try:
+                function(*args)
+            except Exception:
+                logger.exception(f"{function.__name__} failed for {', '.join(map(str, args))}")
+
+    def _derive(self, video_id, start_ts):
+        # lazily rebuilt on the next read if this fails
+        timeline.write_timeline(video_id)
+        clips.write_keyframe_index(video_id, start_ts)
+
+    def _merge(self, video_id, next_video_id):
+        # either may have been deleted in the meantime
+        if not utils.get_video_path(video_id).exists() or not utils.get_video_path(next_video_id).exists():
+            logger.info(f"Not coalescing {next_video_id} into {video_id}: one of them no longer exists")
+            return
+        utils.merge([video_id, next_video_id])
+        DETECTION_INDEX.remove_video(next_video_id)
+        DETECTION_INDEX.index_video(video_id)
+        self.coalesced.inc()
@@ -0,0 +1,92 @@
+from collections import deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+IDLE = 'idle'
+ARMED = 'armed'
+RECORDING = 'recording'
+COOLDOWN = 'cooldown'
+
+class RecordingStateMachine():
+    """ Decides when to record from motion and object events.
+
+    idle -> armed:          major motion or an object is seen
+    armed -> recording:     an object and major motion were both seen within their windows
+    armed -> idle:          the windows ran out before both were seen
+    recording -> cooldown:  no object for object_hold seconds
+    cooldown -> recording:  an object is seen again
+    cooldown -> idle:       no motion at all for motion_hold seconds; the recording stops
+
+    Starting needs major motion while keeping a recording alive only needs minor motion,
+    which gives the hysteresis between the two decisions.
+    """
+    def __init__(self, object_window=10, motion_window=5, object_hold=10, motion_hold=5, trace_size=500):
+        self.object_window = object_window
+        self.motion_window = motion_window
+        self.object_hold = object_hold
+        self.motion_hold = motion_hold
+
+        self.state = IDLE
+        self.last_object_ts = float('-inf')
+        self.last_major_motion_ts = float('-inf')
+        self.last_motion_ts = float('-inf')
+        self.trace = deque(maxlen=trace_size)
+
+    def on_motion(self, ts, is_major):
+        self.last_motion_ts = max(self.last_motion_ts, ts)
+        if is_major:
+            self.last_major_motion_ts = max(self.last_major_motion_ts, ts)
+        return self._update(ts, 'major motion' if is_major else 'motion')
+
+    def on_object(self, ts):
+        self.last_object_ts = max(self.last_object_ts, ts)
+        return self._update(ts, 'object')
+
+    def on_tick(self, ts):
+        return self._update(ts, 'timeout')
+
+    def next_deadline(self):
+        """ Time at which the state changes if no further events arrive, or None. """
+        if self.state == ARMED:
+            return max(self.last_object_ts + self.object_window, self.last_major_motion_ts + self.motion_window)
+        if self.state == RECORDING:
+            return self.last_object_ts + self.object_hold
+        if self.state == COOLDOWN:
+            return self.last_motion_ts + self.motion_hold
+        return None
+
+    def _update(self, ts, reason):
+        """ Applies transitions until the state is stable; returns the list of (from, to) transitions taken. """
+        transitions = []
+        while True:
+            next_state = self._next_state(ts)
+            if next_state == self.state:
+                return transitions
+            transitions.append((self.state, next_state))
+            self.trace.append({'ts': ts, 'from': self.state, 'to': next_state, 'reason': reason,
+                               'last_object_ts': self.last_object_ts, 'last_motion_ts': self.last_motion_ts,
+                               'last_major_motion_ts': self.last_major_motion_ts})
+            logger.debug(f"recording state {self.state} -> {next_state} ({reason} at {ts:.3f})")
+            self.state = next_state
+
+    def _next_state(self, ts):
+        object_recent = ts - self.last_object_ts < self.object_window
+        major_motion_recent = ts - self.last_major_motion_ts < self.motion_window
+        if self.state == IDLE:
+            return ARMED if object_recent or major_motion_recent else IDLE
+        if self.state == ARMED:
+            if object_recent and major_motion_recent:
+                return RECORDING
+            return ARMED if object_recent or major_motion_recent else IDLE
+        if self.state == RECORDING:
+            return RECORDING if ts - self.last_object_ts < self.object_hold else COOLDOWN
+        if self.state == COOLDOWN:
+            if ts - self.last_object_ts < self.object_hold:
+                return RECORDING
+            return COOLDOWN if ts - self.last_motion_ts < self.motion_hold else IDLE
+        return self.state
+
+    def get_configs(self):
+        return {"object_window": self.object_window, "motion_window": self.motion_window,
+                "object_hold": self.object_hold, "motion_hold": self.motion_hold}
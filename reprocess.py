@@ -0,0 +1,164 @@
+""" Regenerates per-video detection logs by running a (new) model over the recording archive.
+
+Usage:
+    python reprocess.py --workers 3 --sample-every 20
+    python reprocess.py --model runs/new_ncnn_model --suffix v2    # write <id>.v2.jsonl next to the old logs
+
+Progress is recorded after every video, so an interrupted run picks up where it stopped.
+"""
+import argparse
+import cv2
+from datetime import datetime
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import time
+
+import utils
+from object_detection import load_model, MODEL_PATH
+from track_aggregation import TrackAggregator, is_motion_record
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FPS = 20.0
+
+_model = None
+
+def _init_worker(model_path):
+    global _model
+    # one model per worker; keep each worker's OpenCV on a single thread so workers don't oversubscribe cores
+    cv2.setNumThreads(1)
+    _model = load_model(model_path)
+
+def _reset_tracker(model):
+    predictor = getattr(model, 'predictor', None)
+    for tracker in getattr(predictor, 'trackers', []):
+        tracker.reset()
+
+def detect_video(video_id, sample_every):
+    """ Yields (timestamp, objects) for every sampled frame, decoding one frame at a time. """
+    cap = cv2.VideoCapture(str(utils.get_video_path(video_id)))
+    fps = cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+    start_ts = datetime.strptime(video_id[:14], utils.DATETIME_FORMAT).timestamp()
+    _reset_tracker(_model)
+    frame_index = 0
+    try:
+        while True:
+            # grab() demuxes without decoding, so skipped frames are cheap
+            if not cap.grab():
+                break
+            if frame_index % sample_every == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                # recordings have a variable frame rate since static frames are left out, so the frame's own
+                # timestamp is used; the frame index only stands in where the backend doesn't report one
+                offset = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                if offset <= 0 and frame_index > 0:
+                    offset = frame_index / fps
+                results = _model.track(frame, persist=True, verbose=False)[0]
+                yield round(start_ts + offset, 3), json.loads(results.to_json())
+            frame_index += 1
+    finally:
+        cap.release()
+
+def _read_motion_records(video_id):
+    """ Streams the motion records of the existing log, which reprocessing keeps as they are. """
+    log_path = utils.get_video_log_path(video_id)
+    if not log_path.exists():
+        return
+    with log_path.open('r') as f:
+        for line in f:
+            ts, data = json.loads(line)
+            if is_motion_record(data):
+                yield ts, data
+
+def _output_log_path(video_id, suffix):
+    if suffix:
+        return utils.VIDEO_LOG_DIR / f"{video_id}.{suffix}.jsonl"
+    return utils.get_video_log_path(video_id)
+
+def reprocess_video(args):
+    video_id, sample_every, suffix = args
+    try:
+        return video_id, _reprocess_video(video_id, sample_every, suffix)
+    except Exception as e:
+        return video_id, e
+
+def _reprocess_video(video_id, sample_every, suffix):
+    output_path = _output_log_path(video_id, suffix)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    # aggregate into track records, like DetectionManager does while recording
+    track_aggregator = TrackAggregator()
+    records = []
+    n_detections = 0
+    for ts, objects in detect_video(video_id, sample_every):
+        records.extend(track_aggregator.update(ts, objects))
+        n_detections += len(objects)
+    records.extend(track_aggregator.flush())
+    records.sort(key=lambda r: r[0])
+
+    with tmp_path.open('w') as f:
+        for record in heapq.merge(_read_motion_records(video_id), records, key=lambda r: r[0]):
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, output_path)
+
+    legacy_log_path = utils.get_video_log_path(video_id, jsonl=False)
+    if not suffix and legacy_log_path.exists():
+        # get_video_log prefers the legacy .json log, so retire it in favour of the new one
+        legacy_log_path.rename(utils.TRASH_DIR / legacy_log_path.name)
+    return n_detections
+
+def _state_path(model_path, suffix):
+    return Path('data') / f"reprocess_{Path(model_path).name}_{suffix or 'replace'}.txt"
+
+def _read_done(state_path):
+    if not state_path.exists():
+        return set()
+    with state_path.open('r') as f:
+        return set(line.strip('\n') for line in f)
+
+def _pending_videos(done, min_age):
+    video_ids = utils.get_video_list(max_videos=None, return_id=True)
+    pending = []
+    for video_id in video_ids:
+        if video_id in done:
+            continue
+        # skip a recording that may still be written to
+        if time.time() - utils.get_video_path(video_id).stat().st_mtime < min_age:
+            continue
+        pending.append(video_id)
+    return pending
+
+def reprocess_archive(model_path=MODEL_PATH, workers=None, sample_every=20, suffix=None, restart=False):
+    state_path = _state_path(model_path, suffix)
+    if restart:
+        state_path.unlink(missing_ok=True)
+    pending = _pending_videos(_read_done(state_path), min_age=60)
+    print(f"{len(pending)} videos to reprocess with {model_path}")
+
+    start = time.time()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model_path,)) as pool:
+        tasks = [(video_id, sample_every, suffix) for video_id in pending]
+        for i, (video_id, n_detections) in enumerate(pool.imap_unordered(reprocess_video, tasks), 1):
+            if isinstance(n_detections, Exception):
+                print(f"[{i}/{len(pending)}] {video_id}: failed: {n_detections}")
+                continue
+            with state_path.open('a') as f:
+                f.write(f"{video_id}\n")
+            print(f"[{i}/{len(pending)}] {video_id}: {n_detections} detections ({time.time() - start:.0f}s elapsed)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Regenerate detection logs for archived recordings.")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument('--sample-every', type=int, default=20, help="run the detector on every Nth frame")
+    parser.add_argument('--suffix', default=None, help="write <id>.<suffix>.jsonl next to the old log instead of replacing it")
+    parser.add_argument('--restart', action='store_true', help="ignore progress from a previous run")
+    args = parser.parse_args()
+
+    reprocess_archive(args.model, args.workers, args.sample_every, args.suffix, args.restart)
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+from metrics import REGISTRY
+
+class CacheEntry():
+    def __init__(self, body, etag, tags, dependencies, signature):
+        self.body = body
+        self.etag = etag
+        self.tags = tags
+        self.dependencies = dependencies
+        self.signature = signature
+
+def file_signature(paths):
+    """ mtime and size of each path, or None for missing ones; changes whenever a file or directory listing changes. """
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+class ResponseCache():
+    """ LRU cache of serialized responses, bounded by entry count and total bytes.
+
+    An entry is dropped when one of its tags is invalidated, or on lookup when any of the files or
+    directories it was built from has changed since.
+    """
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = REGISTRY.counter('kittycam_response_cache_hits_total', 'Responses served from the cache')
+        self.misses = REGISTRY.counter('kittycam_response_cache_misses_total', 'Responses built because the cache had no valid entry')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and file_signature(entry.dependencies) == entry.signature:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+            self.hits.inc()
+            return entry
+        if entry is not None:
+            self._remove(key)
+        self.misses.inc()
+        return None
+
+    def put(self, key, body, tags=(), dependencies=(), signature=None):
+        """ Stores body; pass the signature taken before building it, so changes made meanwhile invalidate it. """
+        if signature is None:
+            signature = file_signature(dependencies)
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        entry = CacheEntry(body, etag, set(tags), list(dependencies), signature)
+        if len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key).body)
+            self.entries[key] = entry
+            self.total_bytes += len(body)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted.body)
+        return entry
+
+    def invalidate(self, tag):
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if tag in entry.tags]
+        for key in keys:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= len(entry.body)
+
+
+RESPONSE_CACHE = ResponseCache()
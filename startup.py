@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+import threading
+import time
+
+class StartupTracker():
+    """ Records how long each startup phase took and which components are ready. """
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = {}
+        self.components = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.time() - start, start)
+
+    def record_phase(self, name, seconds, start=None):
+        with self.lock:
+            self.phases[name] = {
+                'started_after': round((start or time.time() - seconds) - self.start_time, 3),
+                'seconds': round(seconds, 3),
+            }
+
+    def add_component(self, name, is_ready, get_seconds=None):
+        """ Registers a component by a readiness check and, optionally, a getter for how long it took. """
+        with self.lock:
+            self.components[name] = (is_ready, get_seconds)
+
+    def is_ready(self):
+        with self.lock:
+            components = list(self.components.values())
+        return len(components) > 0 and all(is_ready() for is_ready, _ in components)
+
+    def report(self):
+        with self.lock:
+            components = dict(self.components)
+            phases = dict(self.phases)
+        for name, (is_ready, get_seconds) in components.items():
+            seconds = get_seconds() if get_seconds is not None else None
+            if seconds is not None and seconds >= 0:
+                phases.setdefault(name, {'seconds': round(seconds, 3)})
+        return {
+            'ready': self.is_ready(),
+            'uptime': round(time.time() - self.start_time, 3),
+            'components': {name: is_ready() for name, (is_ready, _) in components.items()},
+            'phases': phases,
+        }
+
+
+STARTUP = StartupTracker()
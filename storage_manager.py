@@ -0,0 +1,202 @@
+import ffmpeg
+import logging
+import os
+import threading
+import time
+
+from detection_index import DETECTION_INDEX
+import utils
+from video_utils import force_key_frames
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+DAY = 24 * 60 * 60
+
+class StorageManager():
+    """ Keeps recordings within a disk budget, empties the trash bin and re-encodes old videos when idle. """
+    def __init__(self, camera_feeds, max_video_bytes=20*GB, min_free_bytes=1*GB, trash_grace_days=7,
+                 reencode_after_days=14, reencode_crf=30, reencode_preset='slow', max_idle_load=0.5,
+                 check_interval=600):
+        self.camera_feeds = camera_feeds
+        self.max_video_bytes = max_video_bytes
+        self.min_free_bytes = min_free_bytes
+        self.trash_grace_days = trash_grace_days
+        self.reencode_after_days = reencode_after_days
+        self.reencode_crf = reencode_crf
+        self.reencode_preset = reencode_preset
+        self.max_idle_load = max_idle_load
+        self.check_interval = check_interval
+
+        self.is_running = False
+        # set to run maintenance now rather than after check_interval, and to stop
+        self.wake_event = threading.Event()
+        self.lock = threading.Lock()
+        self.last_report = None
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._loop_maintenance)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        print("stopping storage manager...")
+        self.is_running = False
+        self.wake_event.set()
+        self.thread.join()
+        print("storage manager thread joined")
+
+    def _loop_maintenance(self):
+        while self.is_running:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Storage maintenance failed")
+            self.wake_event.wait(self.check_interval)
+            self.wake_event.clear()
+
+    def trigger(self):
+        """ Runs maintenance on the manager's thread as soon as it is free. """
+        self.wake_event.set()
+
+    def run_once(self):
+        with self.lock:
+            report = {
+                'timestamp': int(time.time()),
+                'trash_bytes_reclaimed': self.purge_trash(),
+                'quota_bytes_reclaimed': self.enforce_quota(),
+                'reencode_bytes_reclaimed': self.reencode_old_videos(),
+            }
+            report['bytes_reclaimed'] = (report['trash_bytes_reclaimed'] + report['quota_bytes_reclaimed']
+                                         + report['reencode_bytes_reclaimed'])
+            report.update(self.get_usage())
+            # picks up logs removed above, or changed by reprocessing and merging
+            report['index'] = DETECTION_INDEX.sync(exclude=self._recording_video_ids())
+            self.last_report = report
+        logger.info(f"Storage maintenance reclaimed {report['bytes_reclaimed']} bytes: {report}")
+        return report
+
+    def get_usage(self):
+        video_bytes = sum(p.stat().st_size for p in utils.VIDEO_DIR.glob('*.mp4'))
+        trash_bytes = sum(p.stat().st_size for p in utils.TRASH_DIR.iterdir() if p.is_file()) if utils.TRASH_DIR.exists() else 0
+        return {
+            'video_bytes': video_bytes,
+            'trash_bytes': trash_bytes,
+            'free_bytes': _disk_free(utils.VIDEO_DIR),
+            'max_video_bytes': self.max_video_bytes,
+        }
+
+    def purge_trash(self):
+        if not utils.TRASH_DIR.exists():
+            return 0
+        cutoff = time.time() - self.trash_grace_days * DAY
+        freed = 0
+        for path in utils.TRASH_DIR.iterdir():
+            # rename() into the trash bin keeps the original mtime, so use ctime for when it was trashed
+            if path.is_file() and path.stat().st_ctime < cutoff:
+                freed += path.stat().st_size
+                path.unlink()
+                logger.info(f"Purged from trash-bin: {path}")
+        return freed
+
+    def _eviction_candidates(self):
+        """ Video ids that may be deleted, oldest first. """
+        video_ids = utils.get_video_list(max_videos=None, return_id=True, exclude=self._recording_video_ids())
+        favorites = set(utils.get_favorites())
+        return [v for v in reversed(video_ids) if v not in favorites]
+
+    def _is_over_budget(self, video_bytes):
+        return video_bytes > self.max_video_bytes or _disk_free(utils.VIDEO_DIR) < self.min_free_bytes
+
+    def enforce_quota(self):
+        video_bytes = sum(p.stat().st_size for p in utils.VIDEO_DIR.glob('*.mp4'))
+        freed = 0
+        for video_id in self._eviction_candidates():
+            if not self._is_over_budget(video_bytes):
+                break
+            video_size = utils.get_video_path(video_id).stat().st_size
+            freed += utils.remove_video_by_id(video_id)
+            video_bytes -= video_size
+            logger.info(f"Evicted {video_id} to stay within disk budget")
+        if self._is_over_budget(video_bytes):
+            logger.warning(f"Still over disk budget after eviction: {video_bytes} bytes of videos")
+        return freed
+
+    def _recording_video_ids(self):
+        return set(c.video_id for c in self.camera_feeds if c.get_is_recording())
+
+    def _is_idle(self):
+        if self._recording_video_ids():
+            return False
+        return os.getloadavg()[0] / os.cpu_count() < self.max_idle_load
+
+    def reencode_old_videos(self):
+        cutoff = time.time() - self.reencode_after_days * DAY
+        reencoded = _read_reencoded()
+        freed = 0
+        for video_id in self._eviction_candidates():
+            if not self.is_running or not self._is_idle():
+                break
+            video_path = utils.get_video_path(video_id)
+            if video_id in reencoded or not video_path.exists() or video_path.stat().st_mtime > cutoff:
+                continue
+            saved = self.reencode(video_id)
+            if saved is None:
+                break
+            freed += saved
+            _mark_reencoded(video_id)
+        return freed
+
+    def reencode(self, video_id):
+        """ Re-encodes a video at a higher CRF. Returns bytes saved, or None if interrupted by activity. """
+        video_path = utils.get_video_path(video_id)
+        utils.TMP_DIR.mkdir(exist_ok=True)
+        tmp_path = utils.TMP_DIR / f"{video_id}_reencode.mp4"
+        process = (
+                ffmpeg
+                .input(str(video_path))
+                # the same keyframe spacing as the recording, which clips are cut at, and its frame timestamps
+                # as they are, so static stretches left out of variable frame rate recordings stay out
+                .output(str(tmp_path), vcodec='libx264', crf=self.reencode_crf, preset=self.reencode_preset,
+                        pix_fmt='yuv420p', movflags='+faststart', force_key_frames=force_key_frames(), vsync='vfr')
+                .overwrite_output()
+                .global_args('-loglevel', 'error')
+                .run_async(cmd=['nice', '-n', '19', 'ffmpeg'])
+                )
+        while process.poll() is None:
+            if not self.is_running or self._recording_video_ids():
+                process.kill()
+                process.wait()
+                tmp_path.unlink(missing_ok=True)
+                logger.info(f"Re-encoding of {video_id} interrupted")
+                return None
+            time.sleep(1)
+
+        if process.returncode != 0 or not tmp_path.exists():
+            logger.error(f"Re-encoding of {video_id} failed with code {process.returncode}")
+            tmp_path.unlink(missing_ok=True)
+            return 0
+        old_size = video_path.stat().st_size
+        new_size = tmp_path.stat().st_size
+        if new_size >= old_size:
+            tmp_path.unlink()
+            return 0
+        os.replace(tmp_path, video_path)
+        logger.info(f"Re-encoded {video_id}: {old_size} -> {new_size} bytes")
+        return old_size - new_size
+
+
+def _disk_free(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def _read_reencoded():
+    if not utils.REENCODED_PATH.exists():
+        return set()
+    with utils.REENCODED_PATH.open('r') as f:
+        return set(line.strip('\n') for line in f)
+
+def _mark_reencoded(video_id):
+    with utils.REENCODED_PATH.open('a') as f:
+        f.write(f"{video_id}\n")
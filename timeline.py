@@ -0,0 +1,140 @@
+""" Activity timelines: motion intensity and per-species confidence over a recording, downsampled to a
+fixed number of points for scrubber bars.
+
+Timelines are written when a recording closes and cached next to the logs in logs/timeline/. A cached
+timeline older than its log (after merging or reprocessing) is rebuilt on the next read, which also
+backfills recordings from before timelines existed.
+
+Usage:
+    python timeline.py          # build missing and stale timelines
+"""
+import json
+import logging
+import os
+
+from analytics import to_datetime
+from track_aggregation import is_motion_record, is_track_record
+import utils
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_POINTS = 200
+
+def lttb(points, n_out):
+    """ Largest-Triangle-Three-Buckets: picks n_out of the (x, y) points, sorted by x, that keep the
+    shape of the curve, i.e. its peaks and dips, which plain averaging or striding would flatten. """
+    if n_out >= len(points) or n_out < 3:
+        return list(points)
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        # the next bucket's average is the third corner of the triangles
+        next_start, next_end = end, min(int((i + 2) * bucket_size) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+        ax, ay = points[a]
+        best, best_area = start, -1
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+def _to_ts(timestamp):
+    return timestamp if not isinstance(timestamp, str) else to_datetime(timestamp).timestamp()
+
+def build_timeline(video_log, n_points=TIMELINE_POINTS):
+    """ {'start', 'end', 'motion': [[offset, area]], 'species': {name: [[offset, confidence]]}} with
+    offsets in seconds from the start of the recording, or None for an empty log.
+
+    Motion is the largest contour area of each motion check. A species' confidence at a point in time
+    is the highest of the detections of it in that frame and of the mean confidences of its tracks
+    spanning that time, and 0 while it isn't seen.
+    """
+    motion = []
+    frame_detections = {}
+    tracks = []
+    for timestamp, data in video_log:
+        ts = _to_ts(timestamp)
+        if is_motion_record(data):
+            motion.append((ts, data.get('contour_area_max', 0)))
+        elif is_track_record(data):
+            tracks.append((data['start'], data['end'], data['name'], data['confidence']['mean']))
+        elif isinstance(data, list):
+            confidences = frame_detections.setdefault(ts, {})
+            for o in data:
+                confidences[o['name']] = max(confidences.get(o['name'], 0), o['confidence'])
+
+    times = sorted(set(ts for ts, _ in motion) | set(frame_detections)
+                   | set(ts for start, end, _, _ in tracks for ts in (start, end)))
+    if not times:
+        return None
+    start = times[0]
+    species = set(name for _, _, name, _ in tracks) | set(name for c in frame_detections.values() for name in c)
+    species_series = {}
+    for name in sorted(species):
+        spans = [(s, e, confidence) for s, e, n, confidence in tracks if n == name]
+        series = []
+        for ts in times:
+            confidence = frame_detections.get(ts, {}).get(name, 0)
+            for s, e, track_confidence in spans:
+                if s <= ts <= e:
+                    confidence = max(confidence, track_confidence)
+            series.append((ts, confidence))
+        species_series[name] = series
+
+    def compact(series, digits):
+        return [[round(ts - start, 1), round(value, digits)] for ts, value in lttb(series, n_points)]
+
+    return {
+        'start': start,
+        'end': times[-1],
+        'motion': compact(sorted(motion), 0),
+        'species': {name: compact(series, 3) for name, series in species_series.items()},
+    }
+
+def write_timeline(video_id):
+    """ Builds and caches a recording's timeline; returns it, or None without a log. """
+    video_log = utils.get_video_log(video_id)
+    timeline = build_timeline(video_log) if video_log is not None else None
+    if timeline is None:
+        return None
+    path = utils.get_timeline_path(video_id)
+    tmp_path = path.with_suffix('.json.tmp')
+    utils.TIMELINE_DIR.mkdir(parents=True, exist_ok=True)
+    with tmp_path.open('w') as f:
+        json.dump(timeline, f)
+    os.replace(tmp_path, path)
+    return timeline
+
+def _is_stale(video_id):
+    path = utils.get_timeline_path(video_id)
+    if not path.exists():
+        return True
+    log_paths = [p for p in (utils.get_video_log_path(video_id), utils.get_video_log_path(video_id, jsonl=False)) if p.exists()]
+    return any(p.stat().st_mtime > path.stat().st_mtime for p in log_paths)
+
+def get_timeline(video_id):
+    if _is_stale(video_id):
+        return write_timeline(video_id)
+    with utils.get_timeline_path(video_id).open('r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    built = 0
+    for video_id in utils.get_video_list(max_videos=None, return_id=True):
+        if _is_stale(video_id):
+            try:
+                built += write_timeline(video_id) is not None
+            except Exception:
+                logger.exception(f"Failed to build the timeline of {video_id}")
+    print(f"built {built} timelines")
@@ -0,0 +1,117 @@
+from collections import Counter
+
+UNTRACKED = 'untracked'
+
+class TrackState():
+    def __init__(self, key, ts):
+        self.key = key
+        self.first_ts = ts
+        self.last_ts = ts
+        self.class_votes = Counter()
+        self.n_detections = 0
+        self.confidence_sum = 0.0
+        self.confidence_min = 1.0
+        self.confidence_max = 0.0
+        self.last_box = None
+        self.trajectory = []
+
+    def add(self, ts, detection, trajectory_interval):
+        self.last_ts = ts
+        self.class_votes[detection['name']] += 1
+        self.n_detections += 1
+        confidence = detection['confidence']
+        self.confidence_sum += confidence
+        self.confidence_min = min(self.confidence_min, confidence)
+        self.confidence_max = max(self.confidence_max, confidence)
+        self.last_box = detection['box']
+        if not self.trajectory or ts - self.trajectory[-1][0] >= trajectory_interval:
+            self.trajectory.append([ts, self.last_box])
+
+    @property
+    def name(self):
+        return self.class_votes.most_common(1)[0][0]
+
+    def summary(self):
+        return {
+            'track_id': self.key,
+            'name': self.name,
+            'confidence': round(self.confidence_sum / self.n_detections, 4),
+            'box': self.last_box,
+        }
+
+    def to_record(self):
+        # make sure the final position is part of the trajectory
+        if self.trajectory[-1][0] != self.last_ts:
+            self.trajectory.append([self.last_ts, self.last_box])
+        return {
+            'type': 'track',
+            'track_id': self.key,
+            'name': self.name,
+            'class_votes': dict(self.class_votes),
+            'start': self.first_ts,
+            'end': self.last_ts,
+            'duration': round(self.last_ts - self.first_ts, 3),
+            'detections': self.n_detections,
+            'confidence': {
+                'mean': round(self.confidence_sum / self.n_detections, 4),
+                'min': self.confidence_min,
+                'max': self.confidence_max,
+            },
+            'trajectory': self.trajectory,
+        }
+
+class TrackAggregator():
+    """ Folds per-frame detections into one record per track.
+
+    update() takes (ts, objects) as produced by the object detector and returns the log records
+    that became due: a 'track' record once a track has not been seen for end_after seconds, and a
+    'keyframe' record with the currently visible tracks every keyframe_interval seconds. Detections
+    without a track id are grouped per class.
+
+    Records are timestamped when they are emitted, not with the track's last sighting, so a log stays
+    in time order; a track's own span is in its 'start' and 'end'.
+    """
+    def __init__(self, end_after=5, keyframe_interval=10, trajectory_interval=2):
+        self.end_after = end_after
+        self.keyframe_interval = keyframe_interval
+        self.trajectory_interval = trajectory_interval
+        self.tracks = {}
+        self.last_keyframe_ts = float('-inf')
+        self.last_ts = float('-inf')
+
+    def update(self, ts, objects):
+        self.last_ts = max(self.last_ts, ts)
+        for detection in objects:
+            key = detection.get('track_id')
+            if key is None:
+                key = f"{UNTRACKED}-{detection['name']}"
+            if key not in self.tracks:
+                self.tracks[key] = TrackState(key, ts)
+            self.tracks[key].add(ts, detection, self.trajectory_interval)
+
+        records = self._end_tracks(ts - self.end_after, ts)
+        if objects and ts - self.last_keyframe_ts >= self.keyframe_interval:
+            self.last_keyframe_ts = ts
+            visible = [self.tracks[key].summary() for key in self.tracks if self.tracks[key].last_ts == ts]
+            records.append((ts, {'type': 'keyframe', 'objects': visible}))
+        return records
+
+    def flush(self, ts=None):
+        """ Ends all open tracks, e.g. when a recording stops, with records timestamped ts, or the latest
+        update's time. """
+        return self._end_tracks(float('inf'), self.last_ts if ts is None else ts)
+
+    def _end_tracks(self, cutoff, ts):
+        ended = sorted((key for key, state in self.tracks.items() if state.last_ts < cutoff),
+                       key=lambda key: self.tracks[key].last_ts)
+        return [(ts, self.tracks.pop(key).to_record()) for key in ended]
+
+
+def is_track_record(data):
+    return isinstance(data, dict) and data.get('type') == 'track'
+
+def is_keyframe_record(data):
+    return isinstance(data, dict) and data.get('type') == 'keyframe'
+
+def is_motion_record(data):
+    return isinstance(data, dict) and 'type' not in data
@@ -2,26 +2,52 @@ import json
 from pathlib import Path
 from datetime import datetime
 import logging
+import os
+import shutil
+import tempfile
+import threading
 import ffmpeg
 
+from response_cache import RESPONSE_CACHE
+
 DATETIME_FORMAT = '%Y%m%d%H%M%S'
 DATETIME_FORMAT_READABLE = '%Y/%m/%d %H:%M'
 DATETIME_FORMAT_READABLE_SECOND = '%Y/%m/%d %H:%M:%S'
 
 VIDEO_DIR = Path('static')
 VIDEO_LOG_DIR = Path('logs/byvideo/')
+TIMELINE_DIR = Path('logs/timeline/')
+KEYFRAME_DIR = Path('logs/keyframes/')
 ANALYTICS_DIR = Path('analytics/')
 ANALYTICS_LOCATION_DIR = ANALYTICS_DIR / 'location'
 ANALYTICS_ACTIVE_HOUR_DIR = ANALYTICS_DIR / 'active_hour'
+ANALYTICS_ACTIVE_HOUR_ZONE_DIR = ANALYTICS_DIR / 'active_hour_zone'
 TRASH_DIR = Path('trash-bin')
+TMP_DIR = Path('tmp')
 FAVORITE_PATH = Path('data/favorite.txt')
+PRIMARY_CAMERA_ID = '0'
+REENCODED_PATH = Path('data/reencoded.txt')
 
 logger = logging.getLogger(__name__)
 
-def get_video_list(skip_latest=False, max_videos=200, return_id=False, prefix=None):
+def new_video_id(camera_id=PRIMARY_CAMERA_ID):
+    """ Timestamp id for a new recording; recordings from other cameras carry the camera id as a suffix. """
+    video_id = datetime.now().strftime(DATETIME_FORMAT)
+    if camera_id != PRIMARY_CAMERA_ID:
+        video_id += f"_{camera_id}"
+    return video_id
+
+def get_camera_id(video_id):
+    """ Inverse of the suffix new_video_id adds. """
+    _, _, camera_id = video_id.partition('_')
+    return camera_id or PRIMARY_CAMERA_ID
+
+def get_video_list(skip_latest=False, max_videos=200, return_id=False, prefix=None, exclude=None):
     video_files = list(VIDEO_DIR.iterdir())
     if prefix:
         video_files = [file for file in video_files if file.stem.startswith(prefix)]
+    if exclude:
+        video_files = [file for file in video_files if file.stem not in exclude]
     video_files.sort(reverse=True)
     if skip_latest:
         video_files = video_files[1:]
@@ -33,11 +59,14 @@ def get_video_list(skip_latest=False, max_videos=200, return_id=False, prefix=No
         return video_files
 
 def get_favorites():
+    if not FAVORITE_PATH.exists():
+        return []
     with FAVORITE_PATH.open('r') as f:
         lines = f.readlines()
         return [line.strip('\n') for line in lines]
 
 def set_favorite(video_id, delete=False):
+    RESPONSE_CACHE.invalidate('favorites')
     if not delete:
         with FAVORITE_PATH.open('a') as f:
             f.write(f"{video_id}\n")
@@ -75,15 +104,20 @@ def get_video_log(video_id):
             return detections
 
 def get_latest(dir):
-    files = list(dir.iterdir())
+    files = [f for f in dir.iterdir() if f.suffix == '.json']
     files.sort(reverse=True)
     return files[0]
 
 def write_analytics(data, dir):
     today = str(datetime.now().date())
     output_path = dir / (today + '.json')
-    with output_path.open('w') as f:
+    tmp_path = dir / (today + '.json.tmp')
+    dir.mkdir(parents=True, exist_ok=True)
+    with tmp_path.open('w') as f:
         json.dump(data, f)
+    # replacing rather than rewriting in place updates the directory mtime, which cached responses watch
+    os.replace(tmp_path, output_path)
+    RESPONSE_CACHE.invalidate('analytics')
 
 def get_analytics(dir, return_json):
     file = get_latest(dir)
@@ -102,11 +136,18 @@ def write_active_hour_analytics(data):
 def get_active_hour_analytics(return_json=True):
     return get_analytics(ANALYTICS_ACTIVE_HOUR_DIR, return_json)
 
+def write_active_hour_zone_analytics(data):
+    write_analytics(data, ANALYTICS_ACTIVE_HOUR_ZONE_DIR)
+
+def get_active_hour_zone_analytics(return_json=True):
+    return get_analytics(ANALYTICS_ACTIVE_HOUR_ZONE_DIR, return_json)
+
 def delete_video(filename):
     p = Path(filename)
     delete_video_by_id(p.stem)
 
 def delete_video_by_id(video_id):
+    RESPONSE_CACHE.invalidate('videos')
     video_path = VIDEO_DIR / f"{video_id}.mp4"
     video_log_path = VIDEO_LOG_DIR / f"{video_id}.json"
     video_jsonl_log_path = VIDEO_LOG_DIR / f"{video_id}.jsonl"
@@ -123,6 +164,19 @@ def delete_video_by_id(video_id):
         video_jsonl_log_path.rename(TRASH_DIR / video_jsonl_log_path.name)
     else:
         logger.error(f"File for deletion can't be found: {video_log_path}")
+    _remove_derived(video_id)
+
+def remove_video_by_id(video_id):
+    """ Permanently deletes a video and its log, returning the number of bytes freed. """
+    RESPONSE_CACHE.invalidate('videos')
+    freed = 0
+    for path in (get_video_path(video_id), get_video_log_path(video_id), get_video_log_path(video_id, jsonl=False)):
+        if path.exists():
+            freed += path.stat().st_size
+            path.unlink()
+            logger.info(f"File removed: {path}")
+    _remove_derived(video_id)
+    return freed
 
 def get_video_path(video_id):
     return VIDEO_DIR / (video_id + '.mp4')
@@ -131,32 +185,132 @@ def get_video_log_path(video_id, jsonl=True):
     suffix = '.jsonl' if jsonl else '.json'
     return VIDEO_LOG_DIR / (video_id + suffix)
 
+def get_timeline_path(video_id):
+    return TIMELINE_DIR / (video_id + '.json')
+
+def get_keyframe_index_path(video_id):
+    return KEYFRAME_DIR / (video_id + '.json')
+
+def _remove_derived(video_id):
+    # timelines and keyframe indexes are derived from the log and video, and rebuilt if those come back
+    get_timeline_path(video_id).unlink(missing_ok=True)
+    get_keyframe_index_path(video_id).unlink(missing_ok=True)
+
+def _merge_keyframe_indexes(video_ids):
+    """ Keyframe index (see clips.py) of the videos concatenated in order: each video's keyframes are
+    shifted by the durations of the videos before it and keep their wall-clock times. None unless
+    every video has an index. """
+    merged = None
+    offset = 0
+    for video_id in video_ids:
+        path = get_keyframe_index_path(video_id)
+        if not path.exists():
+            return None
+        with path.open('r') as f:
+            index = json.load(f)
+        if merged is None:
+            merged = {'start': index['start'], 'keyframes': []}
+        merged['keyframes'] += [[pts + offset, wall] for pts, wall in index['keyframes']]
+        offset += index['duration']
+    merged['duration'] = offset
+    return merged
+
+# merges from the web app and the recording finisher must not swap files at the same time
+_merge_lock = threading.Lock()
+
+def _copy_log_lines(video_id, wf):
+    """ Appends a video's log records to wf as JSON lines, one line at a time. """
+    jsonl_path = get_video_log_path(video_id)
+    json_path = get_video_log_path(video_id, jsonl=False)
+    if jsonl_path.exists():
+        with jsonl_path.open('r') as rf:
+            for line in rf:
+                # a recording cut off mid-write can end without a newline
+                wf.write(line if line.endswith('\n') else line + '\n')
+    elif json_path.exists():
+        # legacy logs are a single JSON array
+        with json_path.open('r') as rf:
+            for record in json.load(rf):
+                wf.write(json.dumps(record) + '\n')
+
+def _finish_merge(staging_dir):
+    """ Completes or rolls back the swap of a staged merge and removes the staging directory. The merged
+    log is moved into place last, so the swap committed exactly when the originals were moved aside and
+    the log is no longer staged. Returns whether it committed. """
+    old_dir = staging_dir / 'old'
+    committed = old_dir.exists() and not (staging_dir / 'log.jsonl').exists()
+    if old_dir.exists():
+        TRASH_DIR.mkdir(exist_ok=True)
+        for path in old_dir.iterdir():
+            if committed:
+                os.replace(path, TRASH_DIR / path.name)
+            else:
+                # restoring the first video also replaces the merged one, if it was already moved in
+                os.replace(path, (VIDEO_DIR if path.suffix == '.mp4' else VIDEO_LOG_DIR) / path.name)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return committed
+
+def recover_merges():
+    """ Finishes merges interrupted by a crash. Call at startup. It holds the merge lock, as the web server
+    may already be taking merge requests, and a merge in progress must not be taken for a crashed one. """
+    with _merge_lock:
+        if not TMP_DIR.exists():
+            return
+        for staging_dir in TMP_DIR.glob('merge_*'):
+            if staging_dir.is_dir():
+                committed = _finish_merge(staging_dir)
+                logger.warning(f"Recovered interrupted merge {staging_dir.name}: {'committed' if committed else 'rolled back'}")
+
 def merge(video_ids):
-    video_ids.sort()
+    """ Concatenates videos and their logs into the first (oldest) one and returns its id.
+
+    The merged video and log are staged in a directory under TMP_DIR. Only once both are complete are
+    the originals moved aside and the merged files renamed into place; if anything fails before that
+    finishes, the originals are restored and the error is raised. The originals end up in the trash.
+    """
+    video_ids = sorted(video_ids)
     new_video_id = video_ids[0]
-    
-    # Merge videos
-    filelist_name = f'merge_filelist_{new_video_id}.txt'
-    new_video_filename = VIDEO_DIR / f"{new_video_id}_new.mp4"
-    with open(filelist_name, 'w') as f:
-        for video in video_ids:
-            f.write(f"file 'static/{video}.mp4'\n")
-    ffmpeg.input(filelist_name, format='concat', safe=0).output(str(new_video_filename), c='copy').run()
-
-    # Merge video logs
-    new_log_file = VIDEO_LOG_DIR / (new_video_id + '_new.jsonl')
-    with new_log_file.open('w') as wf:
-        for vid in video_ids:
-            file = VIDEO_LOG_DIR / (vid + '.jsonl')
-            with file.open('r') as rf:
-                wf.write(rf.read())
-
-    # Delete old videos and logs
-    for vid in video_ids:
-        delete_video_by_id(vid)
-    
-    # Move new video and log to proper paths
-    new_video_filename.rename(get_video_path(new_video_id))
-    new_log_file.rename(get_video_log_path(new_video_id))
+    keyframe_index = None
+    with _merge_lock:
+        TMP_DIR.mkdir(exist_ok=True)
+        staging_dir = Path(tempfile.mkdtemp(prefix=f"merge_{new_video_id}_", dir=TMP_DIR))
+        try:
+            filelist = staging_dir / 'filelist.txt'
+            with filelist.open('w') as f:
+                for video_id in video_ids:
+                    f.write(f"file '{get_video_path(video_id).resolve()}'\n")
+            new_video_path = staging_dir / 'video.mp4'
+            (
+                ffmpeg
+                .input(str(filelist), format='concat', safe=0)
+                .output(str(new_video_path), c='copy')
+                .global_args('-loglevel', 'error')
+                .run()
+            )
+
+            new_log_path = staging_dir / 'log.jsonl'
+            with new_log_path.open('w') as wf:
+                for video_id in video_ids:
+                    _copy_log_lines(video_id, wf)
+            keyframe_index = _merge_keyframe_indexes(video_ids)
 
-    Path(filelist_name).unlink()
+            old_dir = staging_dir / 'old'
+            old_dir.mkdir()
+            for video_id in video_ids:
+                for path in (get_video_path(video_id), get_video_log_path(video_id), get_video_log_path(video_id, jsonl=False)):
+                    if path.exists():
+                        os.replace(path, old_dir / path.name)
+            os.replace(new_video_path, get_video_path(new_video_id))
+            os.replace(new_log_path, get_video_log_path(new_video_id))
+        finally:
+            if not _finish_merge(staging_dir):
+                logger.error(f"Merge of {', '.join(video_ids)} failed, originals kept")
+            RESPONSE_CACHE.invalidate('videos')
+        for video_id in video_ids:
+            _remove_derived(video_id)
+        if keyframe_index is not None:
+            # imported here as clips imports this module
+            from clips import _write_index
+            _write_index(new_video_id, keyframe_index)
+    logger.info(f"Merged {', '.join(video_ids)} into {new_video_id}")
+    return new_video_id
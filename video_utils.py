@@ -2,26 +2,72 @@ import ffmpeg
 import logging
 import json
 import threading
+import time
 
+from detection_index import DETECTION_INDEX
+from metrics import REGISTRY
 import utils
 
+logger = logging.getLogger(__name__)
+
+WRITE_LATENCY = REGISTRY.histogram('kittycam_encoder_write_seconds', 'Time spent piping a frame to the ffmpeg encoder')
+FRAMES_WRITTEN = REGISTRY.counter('kittycam_encoder_frames_total', 'Frames piped to the ffmpeg encoder')
+FRAMES_ELIDED = REGISTRY.counter('kittycam_encoder_frames_elided_total', 'Static frames left out of variable frame rate recordings')
+
+KEYFRAME_INTERVAL = 2.0
+
+def force_key_frames(interval=KEYFRAME_INTERVAL):
+    """ ffmpeg force_key_frames expression for a keyframe every interval seconds of video. """
+    return f'expr:gte(t,n_forced*{interval})'
+
 class VideoWriter():
-    """ For writing a single video. """
-    def __init__(self, video_id):
-        output_path = str(utils.VIDEO_DIR / (video_id + '.mp4'))
+    """ For writing a single video.
+
+    With variable_frame_rate, frames are timestamped when they are written rather than assumed to
+    arrive at 20 fps, so frames can be left out without changing the playback speed. write() then
+    skips frames marked static, keeping one every static_frame_interval seconds. With mjpeg, frames are
+    JPEG bytes as delivered by the camera, which ffmpeg decodes itself. A keyframe is forced every
+    keyframe_interval seconds of video, which bounds how far before a seek point playback or a stream
+    copied clip has to start.
+    """
+    def __init__(self, video_id, output_dir=utils.VIDEO_DIR, variable_frame_rate=False, static_frame_interval=1.0, mjpeg=False,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        output_path = str(output_dir / (video_id + '.mp4'))
+        self.variable_frame_rate = variable_frame_rate
+        self.static_frame_interval = static_frame_interval
+        self.last_write_time = 0
 
+        if variable_frame_rate:
+            input_args = {'use_wallclock_as_timestamps': 1}
+            output_args = {'vsync': 'vfr'}
+        else:
+            input_args = {'r': 20.0}
+            output_args = {}
+        if mjpeg:
+            input_args['format'] = 'mjpeg'
+        else:
+            input_args.update(format='rawvideo', pix_fmt='bgr24', s='640X480')
         self.process = (
                 ffmpeg
-                .input('pipe:', format='rawvideo', pix_fmt='bgr24', s='640X480', r=20.0)
-                .output(output_path, pix_fmt='yuv420p', vcodec='libx264')
+                .input('pipe:', **input_args)
+                .output(output_path, pix_fmt='yuv420p', vcodec='libx264',
+                        force_key_frames=force_key_frames(keyframe_interval), **output_args)
                 .overwrite_output()
                 .run_async(pipe_stdin=True)
                 )
         self.is_active = True
         
-    def write(self, frame):
-        if self.is_active:
-            self.process.stdin.write(frame.tobytes())
+    def write(self, frame, is_static=False):
+        if not self.is_active:
+            return
+        now = time.time()
+        if self.variable_frame_rate and is_static and now - self.last_write_time < self.static_frame_interval:
+            FRAMES_ELIDED.inc()
+            return
+        with WRITE_LATENCY.time():
+            self.process.stdin.write(frame if isinstance(frame, bytes) else frame.tobytes())
+        self.last_write_time = now
+        FRAMES_WRITTEN.inc()
 
     def release(self):
         self.is_active = False
@@ -36,19 +82,22 @@ class VideoWriter():
 
 class VideoLogger():
     def __init__(self, video_id):
-        self.logger = logging.getLogger(f"detection_logger")
-        self.logger.setLevel(logging.INFO)
-        
-        self.file_handler = logging.FileHandler(utils.VIDEO_LOG_DIR / f"{video_id}.jsonl", mode='a')
-        self.logger.addHandler(self.file_handler)
+        self.video_id = video_id
+        # a plain file per video: named loggers are never freed, so one per recording would pile up.
+        # Line buffering writes each record out as it is logged, like the logging handler did
+        self.file = open(utils.VIDEO_LOG_DIR / f"{video_id}.jsonl", 'a', buffering=1)
     
     def log(self, data):
-        self.logger.info(json.dumps(data))
+        self.file.write(json.dumps(data) + '\n')
+        _, record = data
+        try:
+            DETECTION_INDEX.add_record(self.video_id, record)
+        except Exception:
+            # the log file is the source of truth; the next sync re-indexes it
+            logger.exception(f"Failed to index a record of {self.video_id}")
 
     def close(self):
-        self.logger.removeHandler(self.file_handler)
-        if self.file_handler is not None:
-            self.file_handler.close()
+        self.file.close()
 
 class VideoLoggerHandler():
     def __init__(self):
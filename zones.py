@@ -0,0 +1,116 @@
+""" Per-camera include/exclude zones, read from data/zones.json:
+
+    {
+        "0": {
+            "size": [640, 480],
+            "zones": [
+                {"name": "porch", "type": "include", "points": [[40, 200], [600, 200], [600, 480], [40, 480]]},
+                {"name": "plant", "type": "exclude", "points": [[500, 200], [600, 200], [600, 300], [500, 300]]}
+            ]
+        }
+    }
+
+Points are pixels of a frame of the given size. Without include zones the whole frame is included;
+exclude zones are cut out of whatever is included.
+"""
+import json
+from pathlib import Path
+
+ZONES_PATH = Path('data/zones.json')
+# zone name reported for detections on cameras without include zones
+FULL_FRAME = 'frame'
+
+def _on_segment(x, y, a, b):
+    (xa, ya), (xb, yb) = a, b
+    cross = (xb - xa) * (y - ya) - (yb - ya) * (x - xa)
+    return abs(cross) < 1e-9 and min(xa, xb) <= x <= max(xa, xb) and min(ya, yb) <= y <= max(ya, yb)
+
+def _point_in_polygon(x, y, points):
+    """ Even-odd test; points on an edge count as inside, e.g. the anchor of a box touching a zone edge
+    that lies on the frame border. """
+    inside = False
+    j = len(points) - 1
+    for i in range(len(points)):
+        xi, yi = points[i]
+        xj, yj = points[j]
+        if _on_segment(x, y, points[j], points[i]):
+            return True
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def anchor_point(detection):
+    """ Bottom centre of a detection's box, roughly where the animal stands. """
+    box = detection['box']
+    return (box['x1'] + box['x2']) / 2, box['y2']
+
+class CameraZones():
+    def __init__(self, zones=(), size=(640, 480)):
+        self.size = tuple(size)
+        self.include = [z for z in zones if z.get('type', 'include') == 'include']
+        self.exclude = [z for z in zones if z.get('type') == 'exclude']
+        # rasterized masks and crop boxes per frame size, computed on first use
+        self.masks = {}
+        self.crop_boxes = {}
+
+    def is_empty(self):
+        return not self.include and not self.exclude
+
+    def _scaled_points(self, zone, width, height):
+        import numpy as np
+        sx, sy = width / self.size[0], height / self.size[1]
+        return np.array([[round(x * sx), round(y * sy)] for x, y in zone['points']], dtype=np.int32)
+
+    def mask(self, width, height):
+        """ uint8 mask of the included area for a frame of the given size, or None if everything is included. """
+        if self.is_empty():
+            return None
+        if (width, height) not in self.masks:
+            import cv2
+            import numpy as np
+            mask = np.zeros((height, width), np.uint8) if self.include else np.full((height, width), 255, np.uint8)
+            for zone in self.include:
+                cv2.fillPoly(mask, [self._scaled_points(zone, width, height)], 255)
+            for zone in self.exclude:
+                cv2.fillPoly(mask, [self._scaled_points(zone, width, height)], 0)
+            self.masks[(width, height)] = mask
+        return self.masks[(width, height)]
+
+    def crop_box(self, width, height):
+        """ (x1, y1, x2, y2) bounding the included area, or None when that is the whole frame. """
+        if not self.include:
+            return None
+        if (width, height) not in self.crop_boxes:
+            import cv2
+            x, y, w, h = cv2.boundingRect(self.mask(width, height))
+            box = (x, y, x + w, y + h)
+            self.crop_boxes[(width, height)] = None if box == (0, 0, width, height) or w == 0 or h == 0 else box
+        return self.crop_boxes[(width, height)]
+
+    def zone_of(self, detection, frame_size=None):
+        """ Name of the include zone a detection stands in; None if it is outside all of them or excluded. """
+        x, y = anchor_point(detection)
+        if frame_size is not None:
+            x, y = x * self.size[0] / frame_size[0], y * self.size[1] / frame_size[1]
+        for zone in self.exclude:
+            if _point_in_polygon(x, y, zone['points']):
+                return None
+        if not self.include:
+            return FULL_FRAME
+        for zone in self.include:
+            if _point_in_polygon(x, y, zone['points']):
+                return zone['name']
+        return None
+
+    def contains(self, detection, frame_size=None):
+        return self.zone_of(detection, frame_size) is not None
+
+
+def load_zones(path=ZONES_PATH):
+    """ CameraZones per camera id; cameras without an entry get none. """
+    if not path.exists():
+        return {}
+    with path.open('r') as f:
+        config = json.load(f)
+    return {camera_id: CameraZones(c.get('zones', []), c.get('size', (640, 480))) for camera_id, c in config.items()}